@@ -1,11 +1,13 @@
 MODULE_NAME = 'aws'
 
-from subcontractor_plugins.aws.lib import create, create_rollback, destroy, set_power, power_state
+from subcontractor_plugins.aws.lib import create, create_rollback, create_batch, destroy, set_power, power_state, power_state_batch
 
 MODULE_FUNCTIONS = {
                      'create': create,
                      'create_rollback': create_rollback,
+                     'create_batch': create_batch,
                      'destroy': destroy,
                      'set_power': set_power,
-                     'power_state': power_state
+                     'power_state': power_state,
+                     'power_state_batch': power_state_batch
                    }
@@ -1,27 +1,135 @@
 import logging
 import boto3
+import threading
 import time
+from datetime import datetime, timedelta
 from botocore.exceptions import WaiterError
 
 from subcontractor.credentials import getCredentials
 
 
 POLL_INTERVAL = 3
-POWER_SET_TIMEOUT = int( 30 / POLL_INTERVAL )
+POLL_MAX_INTERVAL = 30
+POWER_SET_TIMEOUT = 300  # in seconds
+DESTROY_TIMEOUT = 600  # in seconds
+CREATE_TIMEOUT = 600  # in seconds
+POWER_TARGET_STATE_MAP = { 'on': 'running', 'off': 'stopped', 'soft_off': 'stopped' }
+DESCRIBE_FILTER_MAX_VALUES = 200  # max values EC2 accepts per filter
+DESCRIBE_MAX_RESULTS = 1000
+SESSION_MAX_AGE = 3600  # in seconds
+
+_session_cache = {}  # ( region, token ) -> ( session, created )
+_session_cache_lock = threading.Lock()
+_resource_cache = threading.local()  # boto3 resources are not thread safe, so each thread gets its own from the shared session
+
+
+def _get_session( region_name, token ):
+  key = ( region_name, token )
+  now = time.time()
+  with _session_cache_lock:
+    try:
+      ( session, created ) = _session_cache[ key ]
+      if now - created < SESSION_MAX_AGE:
+        return session, created
+
+    except KeyError:
+      pass
+
+    logging.debug( 'aws: new session for region "{0}"'.format( region_name ) )
+    session = boto3.session.Session( region_name=region_name, aws_session_token=token )
+    _session_cache[ key ] = ( session, now )
+
+    return session, now
 
 
 #  TODO: pass credentals in from contractor, for now put them in your env or ~/.aws/credentials
-def _connect():
-  logging.debug( 'aws: connecting to EC2' )
+def _connect( region_name=None ):
   token = None
   token = getCredentials( token )
-  return boto3.resource( service_name='ec2',
-                         # region_name='us-west-2',
-                         # aws_access_key_id=ACCESS_KEY,
-                         # aws_secret_access_key=SECRET_KEY,
-                         aws_session_token=token,
-                         use_ssl=True,
-                         verify=True )
+  key = ( region_name, token )
+
+  session, created = _get_session( region_name, token )
+
+  try:
+    resource_map = _resource_cache.resource_map
+  except AttributeError:
+    resource_map = _resource_cache.resource_map = {}
+
+  try:
+    ( ec2, resource_created ) = resource_map[ key ]
+    if resource_created == created:  # the session was not replaced since this resource was made
+      return ec2
+
+  except KeyError:
+    pass
+
+  logging.debug( 'aws: connecting to EC2' )
+  with _session_cache_lock:  # sessions are not thread safe either
+    ec2 = session.resource( service_name='ec2',
+                            use_ssl=True,
+                            verify=True )
+
+  resource_map[ key ] = ( ec2, created )
+  return ec2
+
+
+def _describe_instances( ec2, instance_id_list ):
+  # using a filter instead of InstanceIds, so ids that no longer exist don't fail the whole call
+  paginator = ec2.meta.client.get_paginator( 'describe_instances' )
+  for i in range( 0, len( instance_id_list ), DESCRIBE_FILTER_MAX_VALUES ):
+    filter_list = [ { 'Name': 'instance-id', 'Values': instance_id_list[ i:i + DESCRIBE_FILTER_MAX_VALUES ] } ]
+    for page in paginator.paginate( Filters=filter_list, PaginationConfig={ 'PageSize': DESCRIBE_MAX_RESULTS } ):
+      for reservation in page[ 'Reservations' ]:
+        for instance in reservation[ 'Instances' ]:
+          yield instance
+
+
+def _wait_for_state( ec2, instance_id_list, target_state, timeout ):
+  # one Describe call per round for all the instances, backing off between rounds
+  finish_by = datetime.utcnow() + timedelta( seconds=timeout )
+  interval = POLL_INTERVAL
+  while True:
+    instance_map = dict( ( instance[ 'InstanceId' ], instance ) for instance in _describe_instances( ec2, instance_id_list ) )
+    state_map = dict( ( instance_id, instance[ 'State' ][ 'Name' ] ) for instance_id, instance in instance_map.items() )
+    pending_list = [ i for i in instance_id_list if state_map.get( i ) != target_state ]
+    if not pending_list:
+      return instance_map
+
+    if target_state != 'terminated':
+      for instance_id in pending_list:
+        if state_map.get( instance_id ) in ( 'shutting-down', 'terminated' ):
+          raise Exception( 'AWS EC2 instance "{0}" terminated while waiting for "{1}"'.format( instance_id, target_state ) )
+
+    remaining = ( finish_by - datetime.utcnow() ).total_seconds()
+    if remaining <= 0:
+      raise Exception( 'Timeout waiting for AWS EC2 instance(s) "{0}" to be "{1}"'.format( '", "'.join( pending_list ), target_state ) )
+
+    logging.debug( 'aws: waiting for {0} instance(s) to be "{1}"...'.format( len( pending_list ), target_state ) )
+    time.sleep( min( interval, remaining ) )  # the last round lands on the deadline, there is one more Describe after it
+    interval = min( interval * 2, POLL_MAX_INTERVAL )
+
+
+def _instance_paramaters( paramaters, count ):
+  return {
+           'ImageId': paramaters[ 'image_id' ],
+           'InstanceType': paramaters[ 'instance_type' ],
+           'TagSpecifications': [ { 'ResourceType': 'instance', 'Tags': [ { 'Key': 'Name', 'Value': paramaters[ 'name' ] } ] } ],
+           'KeyName': 'xps13',
+           'MinCount': count,
+           'MaxCount': count,
+           'InstanceInitiatedShutdownBehavior': 'stop'
+         }
+
+
+def _interface_map( network_interface_list ):
+  interface_list = []
+  ip_address_map = {}
+  for iface in network_interface_list:
+    name = 'eth{0}'.format( iface[ 'Attachment' ][ 'DeviceIndex' ] )
+    interface_list.append( { 'name': name, 'mac': iface[ 'MacAddress' ] } )
+    ip_address_map[ name ] = ( iface.get( 'Association' ) or {} ).get( 'PublicIp', None )  # no Association without a public ip
+
+  return interface_list, ip_address_map
 
 
 #  https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.ServiceResource.create_instances
@@ -30,24 +138,12 @@ def create( paramaters ):
   logging.info( 'aws: creating instance "{0}"'.format( instance_name ) )
   ec2 = _connect()
 
-  instance_paramaters = {
-                          'ImageId': paramaters[ 'image_id' ],
-                          'InstanceType': paramaters[ 'instance_type' ],
-                          # 'TagSpecifications': [ { 'ResourceType': 'instance', 'Tags': [ { 'Name': instance_name } ] } ],
-                          'KeyName': 'xps13',
-                          'MinCount': 1,
-                          'MaxCount': 1,
-                          'InstanceInitiatedShutdownBehavior': 'stop'
-                        }
-
-  instance_list = ec2.create_instances( **instance_paramaters )
+  instance_list = ec2.create_instances( **_instance_paramaters( paramaters, 1 ) )
   if len( instance_list ) != 1:
     raise Exception( 'Tried to make 1 instance, got {0}'.format( len( instance_list ) ) )
 
   instance = instance_list[0]
 
-  ec2.Tag( instance.id, 'Name', instance_name )  # TODO: remove this and use TagSpecifications when using newer version of boto3
-
   logging.info( 'aws: waiting for creation of "{0}"'.format( instance_name ) )
   try:
     instance.wait_until_running()
@@ -56,17 +152,44 @@ def create( paramaters ):
 
   instance = ec2.Instance( instance.id )  # reloadinstance, get the public ip
 
-  interface_list = []
-  ip_address_map = {}
-  for iface in instance.network_interfaces_attribute:
-    name = 'eth{0}'.format( iface[ 'Attachment' ][ 'DeviceIndex' ] )
-    interface_list.append( { 'name': name, 'mac': iface[ 'MacAddress' ] } )
-    ip_address_map[ name ] = iface[ 'Association' ][ 'PublicIp' ]
+  interface_list, ip_address_map = _interface_map( instance.network_interfaces_attribute )
 
   logging.info( 'aws: instance "{0}" created'.format( instance_name ) )
   return { 'done': True, 'id': instance.id, 'interface_list': interface_list, 'ip_address_map': ip_address_map }
 
 
+def create_batch( paramaters ):
+  # all the instances get the same Name tag, paramaters[ 'name' ], they are told apart by their instance id,
+  # callers that need unique names must rename them
+  instance_name = paramaters[ 'name' ]
+  count = paramaters[ 'count' ]
+  logging.info( 'aws: creating {0} instances of "{1}"'.format( count, instance_name ) )
+  ec2 = _connect()
+
+  instance_list = ec2.create_instances( **_instance_paramaters( paramaters, count ) )
+  instance_id_list = [ instance.id for instance in instance_list ]
+  if len( instance_id_list ) != count:
+    ec2.instances.filter( InstanceIds=instance_id_list ).terminate()
+    raise Exception( 'Tried to make {0} instances, got {1}'.format( count, len( instance_id_list ) ) )
+
+  logging.info( 'aws: waiting for creation of {0} instances of "{1}"'.format( count, instance_name ) )
+  try:  # until the result is built, there is no one else to clean up the instances
+    instance_map = _wait_for_state( ec2, instance_id_list, 'running', paramaters.get( 'timeout', CREATE_TIMEOUT ) )
+
+    result = {}
+    for instance_id in instance_id_list:
+      interface_list, ip_address_map = _interface_map( instance_map[ instance_id ][ 'NetworkInterfaces' ] )
+      result[ instance_id ] = { 'interface_list': interface_list, 'ip_address_map': ip_address_map }
+
+  except Exception:
+    logging.warning( 'aws: batch create of "{0}" failed, terminating {1} instances'.format( instance_name, len( instance_id_list ) ) )
+    ec2.instances.filter( InstanceIds=instance_id_list ).terminate()
+    raise
+
+  logging.info( 'aws: {0} instances of "{1}" created'.format( count, instance_name ) )
+  return { 'done': True, 'instance_map': result }
+
+
 def create_rollback( paramaters ):
   instance_name = paramaters[ 'name' ]
   logging.info( 'aws: rolling back instance "{0}"'.format( instance_name ) )
@@ -86,20 +209,17 @@ def destroy( paramaters ):
 
   instance.terminate()
 
-  try:
-    instance.wait_for_termated()
-  except WaiterError:
-    raise Exception( 'Timeout waiting for AWS EC2 instance "{0}" to be terminated'.format( instance_name ) )
+  _wait_for_state( ec2, [ instance_id ], 'terminated', paramaters.get( 'timeout', DESTROY_TIMEOUT ) )
 
   logging.info( 'aws: instance "{0}" destroyed'.format( instance_name ) )
   return { 'done': True }
 
 
 def _power_state_convert( state ):
-  if state[ 'name' ] in ( 'pending', 'terminated', 'stopped' ):
+  if state[ 'Name' ] in ( 'pending', 'terminated', 'stopped' ):
     return 'off'
 
-  elif state[ 'name' ] in ( 'running', 'shutting-down', 'stopping' ):
+  elif state[ 'Name' ] in ( 'running', 'shutting-down', 'stopping' ):
     return 'on'
 
   else:
@@ -127,19 +247,10 @@ def set_power( paramaters ):
   else:
     raise Exception( 'Unknown desired state "{0}"'.format( desired_state ) )
 
-  counter = 0
-  while True:
-    time.sleep( POLL_INTERVAL )
-    instance = ec2.Instance( instance_id )
-    if instance.state[ 'Name' ] == 'running':
-      break
-
-    counter += 1
-    if counter >= POWER_SET_TIMEOUT:
-      raise Exception( 'Timeout waiting for AWS EC2 instance "{0}" to power "{1}", curent state: "{2}"'.format( instance_name, desired_state, instance.state[ 'Name' ] ) )
+  instance_map = _wait_for_state( ec2, [ instance_id ], POWER_TARGET_STATE_MAP[ desired_state ], paramaters.get( 'timeout', POWER_SET_TIMEOUT ) )
 
   logging.info( 'aws: setting power state of "{0}"({1}) to "{2}" complete'.format( instance_name, instance_id, desired_state ) )
-  return { 'state': _power_state_convert( instance.state ) }
+  return { 'state': _power_state_convert( instance_map[ instance_id ][ 'State' ] ) }
 
 
 def power_state( paramaters ):
@@ -150,3 +261,15 @@ def power_state( paramaters ):
   instance = ec2.Instance( instance_id )
 
   return { 'state': _power_state_convert( instance.state ) }
+
+
+def power_state_batch( paramaters ):
+  instance_id_list = list( paramaters[ 'instance_id_list' ] )
+  logging.info( 'aws: getting power state of {0} instances...'.format( len( instance_id_list ) ) )
+  ec2 = _connect()
+
+  state_map = dict( ( instance_id, 'unknown "not found"' ) for instance_id in instance_id_list )
+  for instance in _describe_instances( ec2, instance_id_list ):
+    state_map[ instance[ 'InstanceId' ] ] = _power_state_convert( instance[ 'State' ] )
+
+  return { 'state_map': state_map }
@@ -1,4 +1,6 @@
 import logging
+import threading
+import time
 from azure.common.credentials import ServicePrincipalCredentials
 from azure.mgmt.resource import ResourceManagementClient
 from azure.mgmt.network import NetworkManagementClient
@@ -9,6 +11,14 @@ from subcontractor.credentials import getCredentials
 
 
 POLL_INTERVAL = 4
+TOKEN_REFRESH_MARGIN = 300  # in seconds, refresh the token when it is this close to expiring
+LOOKUP_CACHE_TTL = 300  # in seconds
+
+_client_cache = {}  # ( tenant_id, client_id, subscription_id, password ) -> AzureClient
+_client_cache_lock = threading.Lock()
+
+_lookup_cache = {}  # ( subscription_id, type, resource_group, name... ) -> ( resource, expires )
+_lookup_cache_lock = threading.Lock()
 
 
 class AzureClient():
@@ -18,6 +28,8 @@ class AzureClient():
     self._resource = None
     self._compute = None
     self._network = None
+    self.token_lock = threading.Lock()
+    self.token_acquired = time.time()
 
   @property
   def resource( self ):
@@ -43,14 +55,86 @@ class AzureClient():
     self._network = NetworkManagementClient( self.credentials, self.subscription_id )
     return self._network
 
+  def _expires_at( self ):
+    token = self.credentials.token
+    try:
+      return float( token[ 'expires_at' ] )  # the parsed epoch, 'expires_on' is a date string
+    except ( KeyError, TypeError, ValueError ):
+      pass
+
+    try:
+      return float( token[ 'expires_in' ] ) + self.token_acquired
+    except ( KeyError, TypeError, ValueError, AttributeError ):
+      return 0
+
+  def refresh_token( self, margin ):
+    if self._expires_at() - time.time() > margin:
+      return
+
+    with self.token_lock:  # only one job per client refreshes, the others wait for it and not for the whole cache
+      if self._expires_at() - time.time() > margin:
+        return
+
+      logging.debug( 'azure: refreshing token for subscription "{0}"'.format( self.subscription_id ) )
+      self.credentials.set_token()  # the management clients share this credentials object, so they pick up the new token
+      self.token_acquired = time.time()
+
+
+def _wait_workers( worker_list, description ):
+  for worker in worker_list:  # they are all running, so this takes as long as the slowest one
+    while not worker.done():
+      logging.debug( 'azure: waiting for {0}...'.format( description ) )
+      worker.wait( POLL_INTERVAL )
+
+
+def _cached_lookup( key, lookup ):
+  # for slowly changing resources, ie: subnets, that are looked up for every create
+  now = time.time()
+  with _lookup_cache_lock:
+    try:
+      ( resource, expires ) = _lookup_cache[ key ]
+      if expires > now:
+        return resource
+
+    except KeyError:
+      pass
+
+  resource = lookup()
+
+  with _lookup_cache_lock:
+    _lookup_cache[ key ] = ( resource, now + LOOKUP_CACHE_TTL )
+
+  return resource
+
+
+def _lookup_invalidate( subscription_id ):
+  with _lookup_cache_lock:
+    for key in [ i for i in _lookup_cache.keys() if i[0] == subscription_id ]:
+      del _lookup_cache[ key ]
+
+
+def _get_subnet( client, resource_group, network, subnet ):
+  return _cached_lookup( ( client.subscription_id, 'subnet', resource_group, network, subnet ),
+                         lambda: client.network.subnets.get( resource_group, network, subnet ) )
+
 
 def _connect( connection_paramaters ):
-  logging.debug( 'azure: connecting with client_id "{0}", tenant_id: "{1}"'.format( connection_paramaters[ 'client_id' ], connection_paramaters[ 'tenant_id' ] ) )
   password = getCredentials( connection_paramaters[ 'password' ] )
+  key = ( connection_paramaters[ 'tenant_id' ], connection_paramaters[ 'client_id' ], connection_paramaters[ 'subscription_id' ], password )
+
+  with _client_cache_lock:
+    client = _client_cache.get( key, None )
+
+  if client is not None:
+    client.refresh_token( TOKEN_REFRESH_MARGIN )  # outside of the cache lock, this can be a round trip to AAD
+    return client
 
-  credentials = ServicePrincipalCredentials( client_id=connection_paramaters[ 'client_id' ], secret=password, tenant=connection_paramaters[ 'tenant_id' ] )
+  logging.debug( 'azure: connecting with client_id "{0}", tenant_id: "{1}"'.format( connection_paramaters[ 'client_id' ], connection_paramaters[ 'tenant_id' ] ) )
+  credentials = ServicePrincipalCredentials( client_id=connection_paramaters[ 'client_id' ], secret=password, tenant=connection_paramaters[ 'tenant_id' ] )  # gets the first token
+  client = AzureClient( credentials, connection_paramaters[ 'subscription_id' ] )
 
-  return AzureClient( credentials, connection_paramaters[ 'subscription_id' ] )
+  with _client_cache_lock:
+    return _client_cache.setdefault( key, client )  # if another job connected at the same time, use the one it cached
 
 
 def create( paramaters ):
@@ -78,10 +162,11 @@ def create( paramaters ):
   # logging.debug( 'azure: create/update resource group "{0}"'.format( resource_group ) )
   # client.resource.create_or_update( resource_group, { 'location': location } )
 
-  nic_list = []
+  # start all the interfaces, the pollers run in the background, then wait for them together
+  worker_list = []
   for i in range( 0, len( vm_paramaters[ 'interface_list' ] ) ):
     interface = vm_paramaters[ 'interface_list' ][ i ]
-    subnet = client.network.subnets.get( resource_group, interface[ 'network' ], 'default' )
+    subnet = _get_subnet( client, resource_group, interface[ 'network' ], 'default' )
     ip_config_list = []
     for config in interface[ 'config_list' ]:
       ip_config_list.append( {
@@ -100,15 +185,16 @@ def create( paramaters ):
                }
 
     try:
-      worker = client.network.network_interfaces.create_or_update( resource_group, interface[ 'name' ], nic_spec )
+      worker_list.append( client.network.network_interfaces.create_or_update( resource_group, interface[ 'name' ], nic_spec ) )
     except CloudError as e:
       raise Exception( 'Error creating network interface "{0}":({1})"{2}"'.format( interface[ 'name' ], e.error.error, e.error.message ) )
 
-    while not worker.done():
-      logging.debug( 'azure: waiting for network interface creation...' )
-      worker.wait( POLL_INTERVAL )
+  _wait_workers( worker_list, 'network interface creation' )
 
+  nic_list = []
+  for worker in worker_list:
     if worker.status() != 'Succeeded':
+      _lookup_invalidate( client.subscription_id )  # incase it was from a stale subnet
       raise Exception( 'Network Interface creation Failed: "{0}"'.format( worker.status() ) )
 
     nic = worker.result()
@@ -181,28 +267,23 @@ def destroy( paramaters ):
     logging.debug( 'azure: waiting for vm delete...' )
     worker.wait( POLL_INTERVAL )
 
+  # the nics and disks don't depend on each other, delete them all at once
+  worker_list = []
   for nic in vm.network_profile.network_interfaces:
     id = nic.id.split( '/' )[ -1 ]
     logging.debug( 'azure: deleting nic "{0}" in "{1}"'.format( id, resource_group ) )
-    worker = client.network.network_interfaces.delete( resource_group, id )
-    while not worker.done():
-      logging.debug( 'azure: waiting for network interface delete...' )
-      worker.wait( POLL_INTERVAL )
+    worker_list.append( client.network.network_interfaces.delete( resource_group, id ) )
 
   id = vm.storage_profile.os_disk.managed_disk.id.split( '/' )[ -1 ]
   logging.debug( 'azure: deleting os disk "{0}" in "{1}"'.format( id, resource_group ) )
-  worker = client.compute.disks.delete( resource_group, id )
-  while not worker.done():
-    logging.debug( 'azure: waiting for is disk delete...' )
-    worker.wait( POLL_INTERVAL )
+  worker_list.append( client.compute.disks.delete( resource_group, id ) )
 
   for disk in vm.storage_profile.data_disks:
     id = disk.managed_disk.id.split( '/' )[ -1 ]
     logging.debug( 'azure: deleting data disk "{0}" in "{1}"'.format( id, resource_group ) )
-    worker = client.compute.disks.delete( resource_group, id )
-    while not worker.done():
-      logging.debug( 'azure: waiting for data disk delete...' )
-      worker.wait( POLL_INTERVAL )
+    worker_list.append( client.compute.disks.delete( resource_group, id ) )
+
+  _wait_workers( worker_list, 'network interface and disk delete' )
 
   logging.info( 'azure: vm "{0}" in "{1}" destroyed'.format( resource_name, resource_group ) )
   return { 'done': True }
@@ -215,7 +296,6 @@ def _power_state_convert( instance_view ):
       code = status.code
       break
 
-  code = instance_view.statuses[ -1 ].code
   if code in ( 'PowerState/deallocating', 'PowerState/deallocated', 'PowerState/stopped', 'PowerState/stopping' ):
     return 'off'
 
@@ -261,3 +341,25 @@ def power_state( paramaters ):
   client = _connect( connection_paramaters )
 
   return { 'state': _power_state_convert( client.compute.virtual_machines.instance_view( resource_group, resource_name ) ) }
+
+
+def power_state_batch( paramaters ):
+  resource_group = paramaters[ 'resource_group' ]
+  resource_name_list = paramaters[ 'resource_name_list' ]
+  connection_paramaters = paramaters[ 'connection' ]
+
+  logging.info( 'azure: get power state of {0} vms in "{1}"...'.format( len( resource_name_list ), resource_group ) )
+  client = _connect( connection_paramaters )
+
+  # statusOnly is only offered on the subscription wide list, the resource group is filtered out here
+  state_map = dict( ( resource_name, 'unknown "not found"' ) for resource_name in resource_name_list )
+  for vm in client.compute.virtual_machines.list_all( status_only='true' ):
+    if vm.id.split( '/' )[ 4 ].lower() != resource_group.lower() or vm.name not in state_map:
+      continue
+
+    if vm.instance_view is None:
+      state_map[ vm.name ] = 'unknown "no instance view"'
+    else:
+      state_map[ vm.name ] = _power_state_convert( vm.instance_view )
+
+  return { 'state_map': state_map }
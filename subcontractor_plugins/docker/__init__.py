@@ -1,11 +1,14 @@
 MODULE_NAME = 'docker'
 
-from subcontractor_plugins.docker.lib import create, create_rollback, destroy, start_stop, state
+from subcontractor_plugins.docker.lib import create, create_rollback, create_batch, create_batch_rollback, destroy, start_stop, state, state_batch
 
 MODULE_FUNCTIONS = {
                      'create': create,
                      'create_rollback': create_rollback,
+                     'create_batch': create_batch,
+                     'create_batch_rollback': create_batch_rollback,
                      'destroy': destroy,
                      'start_stop': start_stop,
-                     'state': state
+                     'state': state,
+                     'state_batch': state_batch
                     }
@@ -1,36 +1,127 @@
 import logging
+import threading
+import time
 import docker
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+CLIENT_IDLE_TIMEOUT = 300  # in seconds
+PULL_CACHE_TTL = 120  # in seconds
+PULL_POLICY_LIST = ( 'always', 'if-not-present', 'if-digest-changed' )
+CREATE_CONCURRENCY = 8
+START_STOP_WAIT_TIMEOUT = 60  # in seconds
+START_STOP_EVENT_MAP = { 'start': 'start', 'stop': 'die' }
+CREATED_TRACK_TTL = 3600  # in seconds, how long the ids of created containers are remembered for rollback
+
+_client_cache = {}  # host -> [ client, last_used, use_count ]
+_client_cache_lock = threading.Lock()
+
+_pull_cache = {}  # ( host, image ) -> ( digest, verified_at )
+_pull_cache_lock = threading.Lock()
+
+_created_map = {}  # ( host, name ) -> ( docker_id, created_at ), the containers this process created, rollback only removes these
+_created_map_lock = threading.Lock()
 
 
 # http://docker-py.readthedocs.io/en/1.10.0/api/
 def _connect( connection_paramaters ):
+  # clients are cached per docker host, so the underlying requests session keeps
+  # its connections alive and the api version is negotiated once, when the
+  # client is first created, idle clients that are not in use are closed and dropped
+  # every _connect must be paired with a _disconnect
   try:
     host = connection_paramaters[ 'host' ]
   except KeyError:
     raise ValueError( '\'host\' is required' )
 
-  logging.debug( 'docker: connecting to docker at "{0}"'.format( host ) )
+  now = time.time()
+  with _client_cache_lock:
+    for cached_host in list( _client_cache.keys() ):
+      ( client, last_used, use_count ) = _client_cache[ cached_host ]
+      if cached_host != host and use_count == 0 and now - last_used > CLIENT_IDLE_TIMEOUT:
+        logging.debug( 'docker: closing idle client for "{0}"'.format( cached_host ) )
+        del _client_cache[ cached_host ]
+        try:
+          client.close()
+        except Exception as e:
+          logging.warning( 'docker: error closing client for "{0}": "{1}"'.format( cached_host, e ) )
 
-  return docker.DockerClient( base_url='tcp://{0}:2376'.format( host ) )
+    try:
+      entry = _client_cache[ host ]
+    except KeyError:
+      logging.debug( 'docker: connecting to docker at "{0}"'.format( host ) )
+      entry = [ docker.DockerClient( base_url='tcp://{0}:2376'.format( host ), version='auto' ), now, 0 ]
+      _client_cache[ host ] = entry
 
+    entry[1] = now
+    entry[2] += 1
+
+  return entry[0]
 
-def create( paramaters ):
-  container_name = paramaters[ 'name' ]
-  connection_paramaters = paramaters[ 'connection' ]
-  logging.info( 'docker: creating container "{0}"'.format( container_name ) )
-  client = _connect( connection_paramaters )
 
-  logging.debug( 'docker: pulling "{0}"'.format( paramaters[ 'docker_image' ] ) )
+def _disconnect( client ):
+  # done with the client, it stays cached, the idle time starts counting from now
+  with _client_cache_lock:
+    for entry in _client_cache.values():
+      if entry[0] is client:
+        entry[1] = time.time()
+        entry[2] -= 1
+        return
+
+
+def _local_image( client, image ):
   try:
-    client.images.pull( paramaters[ 'docker_image' ] )
-  except Exception as e:
-    raise Exception( 'Error Creating Container: {0}'.format( str( e ) ) )
+    return client.images.get( image )
+  except docker.errors.ImageNotFound:
+    return None
+
+
+def _pull_image( client, host, image, pull_policy ):
+  if pull_policy not in PULL_POLICY_LIST:
+    raise ValueError( 'Unknown pull policy "{0}"'.format( pull_policy ) )
+
+  cache_key = ( host, image )
+  if pull_policy != 'always':
+    with _pull_cache_lock:
+      try:
+        ( digest, verified_at ) = _pull_cache[ cache_key ]
+        if time.time() - verified_at < PULL_CACHE_TTL:
+          logging.debug( 'docker: "{0}" on "{1}" recently verified as "{2}"'.format( image, host, digest ) )
+          return
+      except KeyError:
+        pass
+
+  local = None
+  if pull_policy != 'always':
+    local = _local_image( client, image )
+
+  if local is not None and ( pull_policy == 'if-not-present' or '@' in image ):  # images pulled by digest can not change
+    digest = local.id
+
+  else:
+    remote_digest = None
+    if local is not None:
+      try:
+        remote_digest = client.images.get_registry_data( image ).id
+      except Exception as e:
+        logging.warning( 'docker: unable to get registry digest for "{0}", pulling: "{1}"'.format( image, e ) )
+
+    if remote_digest is not None and [ i for i in local.attrs.get( 'RepoDigests', [] ) if i.endswith( '@{0}'.format( remote_digest ) ) ]:
+      digest = remote_digest
+
+    else:
+      logging.debug( 'docker: pulling "{0}"'.format( image ) )
+      digest = client.images.pull( image ).id
+
+  with _pull_cache_lock:
+    _pull_cache[ cache_key ] = ( digest, time.time() )
 
+
+def _create_container( client, paramaters ):
   container_paramaters = {
                           'auto_remove': False,
                           'detach': True,
                           'image': paramaters[ 'docker_image' ],
-                          'name': container_name,
+                          'name': paramaters[ 'name' ],
                           'ports': paramaters[ 'port_map' ],
                           'environment': paramaters[ 'environment_map' ],
                           'command': paramaters[ 'command' ]
@@ -42,23 +133,149 @@ def create( paramaters ):
   except Exception as e:
     raise Exception( 'Error Creating Container: {0}'.format( str( e ) ) )
 
-  docker_id = container.id
+  return container.id
 
-  logging.info( 'docker: container "{0}" created'.format( container_name ) )
-  return { 'done': True, 'id': docker_id }
 
+def _track_created( host, container_name, docker_id ):
+  now = time.time()
+  with _created_map_lock:
+    for key in [ key for key, value in _created_map.items() if now - value[1] > CREATED_TRACK_TTL ]:
+      del _created_map[ key ]
 
-def create_rollback( paramaters ):
+    _created_map[ ( host, container_name ) ] = ( docker_id, now )
+
+
+def _created_id( host, container_name ):
+  # returns the id of the container this process created as container_name, None if it did not create one
+  with _created_map_lock:
+    try:
+      return _created_map.pop( ( host, container_name ) )[0]
+    except KeyError:
+      return None
+
+
+def _remove_container( client, docker_id ):
+  try:
+    container = client.containers.get( docker_id )
+  except docker.errors.NotFound:
+    return
+
+  logging.debug( 'docker: removing "{0}"'.format( docker_id ) )
+  container.remove( force=True )
+
+
+def create( paramaters ):
   container_name = paramaters[ 'name' ]
-  # connection_paramaters = paramaters[ 'connection' ]
+  connection_paramaters = paramaters[ 'connection' ]
+  logging.info( 'docker: creating container "{0}"'.format( container_name ) )
+  client = _connect( connection_paramaters )
+  try:
+    try:
+      _pull_image( client, connection_paramaters[ 'host' ], paramaters[ 'docker_image' ], paramaters.get( 'pull_policy', 'if-digest-changed' ) )
+    except Exception as e:
+      raise Exception( 'Error Creating Container: {0}'.format( str( e ) ) )
+
+    docker_id = _create_container( client, paramaters )
+    _track_created( connection_paramaters[ 'host' ], container_name, docker_id )
+
+    logging.info( 'docker: container "{0}" created'.format( container_name ) )
+    return { 'done': True, 'id': docker_id }
 
+  finally:
+    _disconnect( client )
+
+
+def create_rollback( paramaters ):
+  container_name = paramaters[ 'name' ]
+  connection_paramaters = paramaters[ 'connection' ]
   logging.info( 'docker: rolling back container "{0}"'.format( container_name ) )
+  client = _connect( connection_paramaters )
+  try:
+    docker_id = paramaters.get( 'docker_id', None ) or _created_id( connection_paramaters[ 'host' ], container_name )
+    if docker_id is None:  # the create never got that far, any container with that name belongs to someone else
+      logging.info( 'docker: no container "{0}" was created, nothing to roll back'.format( container_name ) )
+      return { 'rollback_done': True }
+
+    try:
+      _remove_container( client, docker_id )
+    except Exception as e:
+      raise Exception( 'Error Removing Container "{0}": {1}'.format( container_name, str( e ) ) )
 
-  raise Exception( 'docker rollback not implemented, yet' )
-  # client = _connect( connection_paramaters )
+    logging.info( 'docker: container "{0}" rolledback'.format( container_name ) )
+    return { 'rollback_done': True }
 
-  logging.info( 'docker: container "{0}" rolledback'.format( container_name ) )
-  return { 'rollback_done': True }
+  finally:
+    _disconnect( client )
+
+
+def create_batch( paramaters ):
+  container_list = paramaters[ 'container_list' ]
+  connection_paramaters = paramaters[ 'connection' ]
+  logging.info( 'docker: creating {0} containers'.format( len( container_list ) ) )
+  client = _connect( connection_paramaters )
+  try:
+    image_map = {}
+    for container in container_list:
+      image_map[ container[ 'docker_image' ] ] = container.get( 'pull_policy', 'if-digest-changed' )
+
+    for image, pull_policy in image_map.items():
+      try:
+        _pull_image( client, connection_paramaters[ 'host' ], image, pull_policy )
+      except Exception as e:
+        raise Exception( 'Error Creating Container: {0}'.format( str( e ) ) )
+
+    id_map = {}
+    error_list = []
+    with ThreadPoolExecutor( max_workers=max( 1, min( CREATE_CONCURRENCY, len( container_list ) ) ) ) as executor:
+      future_map = dict( ( executor.submit( _create_container, client, container ), container[ 'name' ] ) for container in container_list )
+      for future in as_completed( future_map ):
+        try:
+          id_map[ future_map[ future ] ] = future.result()
+        except Exception as e:
+          error_list.append( str( e ) )
+
+    if error_list:
+      logging.warning( 'docker: batch create failed, removing {0} created containers'.format( len( id_map ) ) )
+      for container_name, docker_id in id_map.items():
+        try:
+          _remove_container( client, docker_id )
+        except Exception as e:
+          logging.warning( 'docker: error removing container "{0}": "{1}"'.format( container_name, e ) )
+
+      raise Exception( 'Error Creating Containers: {0}'.format( '", "'.join( error_list ) ) )
+
+    for container_name, docker_id in id_map.items():
+      _track_created( connection_paramaters[ 'host' ], container_name, docker_id )
+
+    logging.info( 'docker: {0} containers created'.format( len( id_map ) ) )
+    return { 'done': True, 'id_map': id_map }
+
+  finally:
+    _disconnect( client )
+
+
+def create_batch_rollback( paramaters ):
+  container_list = paramaters[ 'container_list' ]
+  connection_paramaters = paramaters[ 'connection' ]
+  logging.info( 'docker: rolling back {0} containers'.format( len( container_list ) ) )
+  client = _connect( connection_paramaters )
+  try:
+    id_map = paramaters.get( 'id_map', None ) or {}  # the id_map create_batch returned, if the caller has it
+    for container in container_list:
+      docker_id = id_map.get( container[ 'name' ], None ) or _created_id( connection_paramaters[ 'host' ], container[ 'name' ] )
+      if docker_id is None:  # not created by us, possibly a name conflict, leave it be
+        continue
+
+      try:
+        _remove_container( client, docker_id )
+      except Exception as e:
+        raise Exception( 'Error Removing Container "{0}": {1}'.format( container[ 'name' ], str( e ) ) )
+
+    logging.info( 'docker: {0} containers rolledback'.format( len( container_list ) ) )
+    return { 'rollback_done': True }
+
+  finally:
+    _disconnect( client )
 
 
 def destroy( paramaters ):
@@ -68,21 +285,24 @@ def destroy( paramaters ):
   logging.info( 'docker: destroying container "{0}"({1})'.format( container_name, docker_id ) )
   client = _connect( connection_paramaters )
   try:
-    container = client.containers.get( docker_id )
-  except Exception as e:
-    raise Exception( 'Error Getting Container "{0}": {1}'.format( docker_id, str( e ) ) )
+    try:
+      container = client.containers.get( docker_id )
+    except Exception as e:
+      raise Exception( 'Error Getting Container "{0}": {1}'.format( docker_id, str( e ) ) )
 
-  try:
-    container.remove( force=True )
-  except Exception as e:
-    raise Exception( 'Error Removing Container "{0}": {1}'.format( docker_id, str( e ) ) )
+    try:
+      container.remove( force=True )
+    except Exception as e:
+      raise Exception( 'Error Removing Container "{0}": {1}'.format( docker_id, str( e ) ) )
+
+    logging.info( 'docker: container "{0}" destroyed'.format( container_name ) )
+    return { 'done': True }
 
-  logging.info( 'docker: container "{0}" destroyed'.format( container_name ) )
-  return { 'done': True }
+  finally:
+    _disconnect( client )
 
 
 def _power_state_convert( state ):
-  print( '****************** {0}'.format(state))
   if state == 'running':
     return 'start'
 
@@ -101,31 +321,79 @@ def start_stop( paramaters ):
   logging.info( 'docker: setting state of "{0}"({1}) to "{2}"...'.format( container_name, docker_id, desired_state ) )
   client = _connect( connection_paramaters )
   try:
-    container = client.containers.get( docker_id )
-  except Exception as e:
-    raise Exception( 'Error Getting Container "{0}": {1}'.format( docker_id, str( e ) ) )
-
-  curent_state = _power_state_convert( container.status )
-  if curent_state == desired_state:
-    return { 'state': curent_state }
-
-  if desired_state == 'start':
     try:
-      container.start()
+      container = client.containers.get( docker_id )
     except Exception as e:
-      raise Exception( 'Error Starting Container "{0}": {1}'.format( docker_id, str( e ) ) )
+      raise Exception( 'Error Getting Container "{0}": {1}'.format( docker_id, str( e ) ) )
+
+    curent_state = _power_state_convert( container.status )
+    if curent_state == desired_state:
+      return { 'state': curent_state }
+
+    events = None
+    if paramaters.get( 'wait', False ):  # subscribe before acting, so the event can't be missed
+      try:
+        event_name = START_STOP_EVENT_MAP[ desired_state ]
+      except KeyError:
+        raise Exception( 'Unknown desired state "{0}"'.format( desired_state ) )
+
+      try:  # no since/until, those are compared to the daemon's clock, the stream starts now and the timeout is enforced here
+        events = client.events( filters={ 'type': 'container', 'container': docker_id, 'event': event_name }, decode=True )
+      except Exception as e:
+        raise Exception( 'Error Getting Events for Container "{0}": {1}'.format( docker_id, str( e ) ) )
+
+      timed_out = threading.Event()
+
+      def _timeout():
+        timed_out.set()
+        events.close()
+
+      timer = threading.Timer( paramaters.get( 'wait_timeout', START_STOP_WAIT_TIMEOUT ), _timeout )
+      timer.daemon = True
+      timer.start()
 
-  elif desired_state == 'stop':
     try:
-      container.stop()
-    except Exception as e:
-      raise Exception( 'Error Stopping Container "{0}": {1}'.format( docker_id, str( e ) ) )
+      if desired_state == 'start':
+        try:
+          container.start()
+        except Exception as e:
+          raise Exception( 'Error Starting Container "{0}": {1}'.format( docker_id, str( e ) ) )
 
-  else:
-    raise Exception( 'Unknown desired state "{0}"'.format( desired_state ) )
+      elif desired_state == 'stop':
+        try:
+          container.stop()
+        except Exception as e:
+          raise Exception( 'Error Stopping Container "{0}": {1}'.format( docker_id, str( e ) ) )
+
+      else:
+        raise Exception( 'Unknown desired state "{0}"'.format( desired_state ) )
+
+      if events is not None:
+        logging.debug( 'docker: waiting for "{0}" event from "{1}"({2})...'.format( event_name, container_name, docker_id ) )
+        found = False
+        try:
+          for event in events:  # the timer closes the stream at the timeout
+            if event.get( 'Action', event.get( 'status' ) ) == event_name:
+              found = True
+              break
+
+        except Exception:
+          if not timed_out.is_set():  # closing the stream under the iterator can raise
+            raise
 
-  logging.info( 'docker: setting state of "{0}"({1}) to "{2}" complete'.format( container_name, docker_id, desired_state ) )
-  return { 'state': desired_state }
+        if not found:
+          raise Exception( 'Timeout waiting for Container "{0}" to "{1}"'.format( docker_id, desired_state ) )
+
+    finally:
+      if events is not None:
+        timer.cancel()
+        events.close()
+
+    logging.info( 'docker: setting state of "{0}"({1}) to "{2}" complete'.format( container_name, docker_id, desired_state ) )
+    return { 'state': desired_state }
+
+  finally:
+    _disconnect( client )
 
 
 def state( paramaters ):
@@ -135,8 +403,42 @@ def state( paramaters ):
   logging.info( 'docker: getting "{0}"({1}) power state...'.format( container_name, docker_id ) )
   client = _connect( connection_paramaters )
   try:
-    container = client.containers.get( docker_id )
-  except Exception as e:
-    raise Exception( 'Error Getting Container "{0}": {1}'.format( docker_id, str( e ) ) )
+    try:
+      container = client.containers.get( docker_id )
+    except Exception as e:
+      raise Exception( 'Error Getting Container "{0}": {1}'.format( docker_id, str( e ) ) )
+
+    return { 'state': _power_state_convert( container.status ) }
+
+  finally:
+    _disconnect( client )
+
+
+def state_batch( paramaters ):
+  docker_id_list = paramaters[ 'docker_id_list' ]
+  connection_paramaters = paramaters[ 'connection' ]
+  logging.info( 'docker: getting power state of {0} containers...'.format( len( docker_id_list ) ) )
+  if not docker_id_list:  # an empty id filter is no filter, that would list every container on the host
+    return { 'state_map': {} }
+
+  client = _connect( connection_paramaters )
+  try:
+    try:
+      container_list = client.containers.list( all=True, sparse=True, filters={ 'id': docker_id_list } )
+    except Exception as e:
+      raise Exception( 'Error Listing Containers: {0}'.format( str( e ) ) )
+
+    state_map = {}
+    for docker_id in docker_id_list:  # the id filter is a prefix match, the requested ids could be short or long
+      for container in container_list:
+        if container.id.startswith( docker_id ):
+          state_map[ docker_id ] = _power_state_convert( container.status )
+          break
+
+      else:
+        state_map[ docker_id ] = 'unknown "not found"'
+
+    return { 'state_map': state_map }
 
-  return { 'state': _power_state_convert( container.status ) }
+  finally:
+    _disconnect( client )
@@ -0,0 +1,242 @@
+import logging
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+from pyVmomi.VmomiSupport import ManagedObject
+
+UPDATE_WAIT_SECONDS = 60  # in seconds, how long each WaitForUpdatesEx blocks on the vCenter when nothing changes
+READY_WAIT = 2  # in seconds, how long a job waits for a loading inventory before doing its lookups the slow way
+RETRY_INTERVAL = 300  # in seconds, after an inventory fails, how long before trying again
+IDLE_TIMEOUT = 900  # in seconds, inventories not used in this long stop tracking and disconnect
+PATH_EXCLUDE_TYPES = ( vim.VirtualMachine, )  # nothing is looked up by a vm path, and vms come and go all the time, keep them out of the path index
+
+"""
+Long lived, per vCenter, index of inventory objects.  The initial contents come from one
+PropertyCollector retrieval, after that the changes are streamed in by WaitForUpdatesEx from a
+background thread with its own connection, so lookups are answered from memory.  The MoRefs
+are bound to the caller's connection before being handed out.
+"""
+
+_inventory_map = {}
+_inventory_map_lock = threading.Lock()
+
+
+class Inventory():
+  def __init__( self, connect, disconnect, property_map ):
+    super().__init__()
+    self._connect = connect
+    self._disconnect = disconnect
+    self.property_map = property_map  # vim type -> list of extra properties to track, 'name' and 'parent' are allways tracked
+    self.lock = threading.Lock()
+    self.ready = threading.Event()
+    self.running = True
+    self.failed = False
+    self.stopped_at = None
+    self.last_used = time.time()
+    self.object_map = {}  # moId -> { 'obj': MoRef, 'name': ..., 'parent': moId, ... }
+    self.name_map = {}  # name -> set( moId ), for all types, find filters by type
+    self.path_map = None  # inventory path -> moId, rebuilt on the first resolve after the tree changes
+    self.thread = threading.Thread( target=self._run, name='vcenter-inventory', daemon=True )
+    self.thread.start()
+
+  @property
+  def alive( self ):
+    return self.running and self.thread.is_alive()
+
+  def _filter_spec( self, si ):
+    view = si.content.viewManager.CreateContainerView( si.content.rootFolder, list( self.property_map.keys() ), True )
+
+    traversal = vmodl.query.PropertyCollector.TraversalSpec( name='traverseView', path='view', skip=False, type=vim.view.ContainerView )
+
+    spec = vmodl.query.PropertyCollector.FilterSpec()
+    spec.objectSet = [ vmodl.query.PropertyCollector.ObjectSpec( obj=view, skip=True, selectSet=[ traversal ] ) ]
+    spec.propSet = [ vmodl.query.PropertyCollector.PropertySpec( type=vim_type, pathSet=[ 'name', 'parent' ] + property_list ) for vim_type, property_list in self.property_map.items() ]
+
+    return view, spec
+
+  def _run( self ):
+    try:
+      si = self._connect()
+    except Exception as e:
+      logging.warning( 'vcenter: inventory unable to connect: "{0}"'.format( e ) )
+      self.failed = True
+      self.stopped_at = time.time()
+      self.running = False
+      self.ready.set()
+      return
+
+    try:
+      collector = si.content.propertyCollector.CreatePropertyCollector()  # our own collector, so our filter doesn't interfere with anyone else's
+      view, spec = self._filter_spec( si )
+      collector.CreateFilter( spec, True )
+
+      options = vmodl.query.PropertyCollector.WaitOptions( maxWaitSeconds=UPDATE_WAIT_SECONDS )
+      version = ''
+      while self.running and time.time() - self.last_used < IDLE_TIMEOUT:
+        update = collector.WaitForUpdatesEx( version, options )
+        if update is None:  # nothing changed
+          continue
+
+        self._apply( update )
+        version = update.version
+        if not update.truncated:
+          self.ready.set()
+
+      collector.DestroyPropertyCollector()
+      view.DestroyView()
+
+    except Exception as e:
+      logging.warning( 'vcenter: inventory stopped tracking changes: "{0}"'.format( e ) )
+      self.failed = True
+
+    finally:
+      self.stopped_at = time.time()
+      self.running = False
+      self.ready.set()
+      try:
+        self._disconnect( si )
+      except Exception:
+        pass
+
+  def _apply( self, update ):
+    with self.lock:
+      for filter_update in update.filterSet:
+        for object_update in filter_update.objectSet:
+          moId = object_update.obj._moId
+          entry = self.object_map.get( moId, None )
+          if entry is not None:
+            self.name_map.get( entry.get( 'name' ), set() ).discard( moId )
+
+          in_path_map = not isinstance( object_update.obj, PATH_EXCLUDE_TYPES )
+          if object_update.kind == 'leave':
+            self.object_map.pop( moId, None )
+            if in_path_map:
+              self.path_map = None
+            continue
+
+          if entry is None:
+            entry = { 'obj': object_update.obj }
+            self.object_map[ moId ] = entry
+
+          if object_update.kind == 'enter' and in_path_map:
+            self.path_map = None
+
+          for change in object_update.changeSet:
+            if change.name in ( 'name', 'parent' ) and in_path_map:
+              self.path_map = None
+
+            if change.op in ( 'remove', 'indirectRemove' ):
+              entry.pop( change.name, None )
+            elif isinstance( change.val, ManagedObject ):
+              entry[ change.name ] = change.val._moId
+            elif isinstance( change.val, list ) and change.val and isinstance( change.val[0], ManagedObject ):  # ie: HostSystem.datastore
+              entry[ change.name ] = [ i._moId for i in change.val ]
+            else:
+              entry[ change.name ] = change.val
+
+          self.name_map.setdefault( entry.get( 'name' ), set() ).add( moId )
+
+  def _within( self, moId, ancestor ):
+    while moId is not None:
+      if moId == ancestor:
+        return True
+
+      moId = self.object_map.get( moId, {} ).get( 'parent', None )
+
+    return False
+
+  def _build_path_map( self ):
+    path_cache = {}
+    for moId in self.object_map:
+      if isinstance( self.object_map[ moId ][ 'obj' ], PATH_EXCLUDE_TYPES ):
+        continue
+
+      chain = []
+      current = moId
+      while current in self.object_map and current not in path_cache:  # the rootFolder is not in the view, so the top of each path is the rootFolder's child
+        chain.append( current )
+        current = self.object_map[ current ].get( 'parent', None )
+
+      path = path_cache.get( current, '' )
+      for item in reversed( chain ):
+        path = '{0}/{1}'.format( path, self.object_map[ item ].get( 'name' ) )
+        path_cache[ item ] = path
+
+    self.path_map = dict( ( path, moId ) for moId, path in path_cache.items() )
+
+  def resolve( self, path ):
+    """
+    returns the moId at the inventory path, ie: '/DC1/host/ClusterA/Resources/pool1', None if
+    nothing is there
+    """
+    self.last_used = time.time()
+    with self.lock:
+      if self.path_map is None:
+        self._build_path_map()
+
+      return self.path_map.get( path.rstrip( '/' ), None )
+
+  def find( self, vim_type, name, within=None ):
+    """
+    returns the list of moIds of vim_type (or sub type) objects named name, if within is
+    specified, only the objects that are under the moId within
+    """
+    self.last_used = time.time()
+    with self.lock:
+      result = []
+      for moId in self.name_map.get( name, [] ):
+        if not isinstance( self.object_map[ moId ][ 'obj' ], vim_type ):
+          continue
+
+        if within is not None and not self._within( moId, within ):
+          continue
+
+        result.append( moId )
+
+      return result
+
+  def get( self, moId, name ):
+    """
+    returns the tracked property name of moId, None if the object or property is not known
+    """
+    self.last_used = time.time()
+    with self.lock:
+      return self.object_map.get( moId, {} ).get( name, None )
+
+  def bind( self, conn, moId ):
+    """
+    returns the object as a MoRef on the connection conn, conn can be the ServiceInstance
+    or any MoRef allready on that connection
+    """
+    with self.lock:
+      obj = self.object_map[ moId ][ 'obj' ]
+
+    return type( obj )( moId, conn._stub )
+
+  def stop( self ):
+    self.running = False
+
+
+def get_inventory( key, connect, disconnect, property_map ):
+  """
+  returns the running Inventory for key, starting one if need be, None if it is still loading
+  or has recently failed, callers should then do the lookup the slow way
+  """
+  with _inventory_map_lock:
+    inventory = _inventory_map.get( key, None )
+    if inventory is not None and not inventory.alive:
+      if inventory.failed and time.time() - inventory.stopped_at < RETRY_INTERVAL:  # don't log in and retrieve everything again for every job
+        return None
+
+      inventory = None
+
+    if inventory is None:
+      inventory = Inventory( connect, disconnect, property_map )
+      _inventory_map[ key ] = inventory
+
+  inventory.last_used = time.time()
+  if not inventory.ready.wait( READY_WAIT ) or not inventory.alive:  # the first jobs don't wait for the whole inventory to load
+    return None
+
+  return inventory
@@ -0,0 +1,147 @@
+import types
+
+from pyVmomi import vim
+
+from subcontractor_plugins.vcenter.inventory import Inventory
+
+
+def _no_connect():
+  raise Exception( 'no vCenter in the tests' )
+
+
+def _inventory():
+  inventory = Inventory( _no_connect, None, {} )
+  inventory.thread.join()  # fails to connect and stops, the bookkeeping is all still there
+  return inventory
+
+
+def _change( name, val, op='assign' ):
+  return types.SimpleNamespace( name=name, val=val, op=op )
+
+
+def _update( *object_update_list ):
+  return types.SimpleNamespace( filterSet=[ types.SimpleNamespace( objectSet=list( object_update_list ) ) ] )
+
+
+def _enter( obj, name, parent=None, **kwargs ):
+  change_list = [ _change( 'name', name ) ]
+  if parent is not None:
+    change_list.append( _change( 'parent', parent ) )
+
+  for key, value in kwargs.items():
+    change_list.append( _change( key, value ) )
+
+  return types.SimpleNamespace( obj=obj, kind='enter', changeSet=change_list )
+
+
+def _modify( obj, *change_list ):
+  return types.SimpleNamespace( obj=obj, kind='modify', changeSet=list( change_list ) )
+
+
+def _leave( obj ):
+  return types.SimpleNamespace( obj=obj, kind='leave', changeSet=[] )
+
+
+root = vim.Folder( 'group-d1' )  # never in the view
+folder1 = vim.Folder( 'group-d2' )
+dc1 = vim.Datacenter( 'datacenter-1' )
+dc2 = vim.Datacenter( 'datacenter-2' )
+host_folder1 = vim.Folder( 'group-h1' )
+host_folder2 = vim.Folder( 'group-h2' )
+cluster_a = vim.ClusterComputeResource( 'domain-c1' )
+resources_a = vim.ResourcePool( 'resgroup-1' )
+pool1 = vim.ResourcePool( 'resgroup-2' )
+cluster_b = vim.ClusterComputeResource( 'domain-c2' )
+vm_folder1 = vim.Folder( 'group-v1' )
+vm_folder2 = vim.Folder( 'group-v2' )
+template1 = vim.VirtualMachine( 'vm-1' )
+template2 = vim.VirtualMachine( 'vm-2' )
+
+
+def _loaded():
+  inventory = _inventory()
+  inventory._apply( _update(
+                             _enter( folder1, 'Folder1', root ),
+                             _enter( dc1, 'DC1', folder1 ),
+                             _enter( dc2, 'DC2', root ),
+                             _enter( host_folder1, 'host', dc1 ),
+                             _enter( host_folder2, 'host', dc2 ),
+                             _enter( cluster_a, 'ClusterA', host_folder1, resourcePool=resources_a ),
+                             _enter( resources_a, 'Resources', cluster_a ),
+                             _enter( pool1, 'pool1', resources_a ),
+                             _enter( cluster_b, 'ClusterA', host_folder2 ),
+                             _enter( vm_folder1, 'vm', dc1 ),
+                             _enter( vm_folder2, 'vm', dc2 ),
+                             _enter( template1, 'template', vm_folder1 ),
+                             _enter( template2, 'template', vm_folder2 )
+                           ) )
+  return inventory
+
+
+def test_nested_paths():
+  inventory = _loaded()
+  assert inventory.resolve( '/Folder1/DC1' ) == 'datacenter-1'
+  assert inventory.resolve( '/Folder1/DC1/host/ClusterA' ) == 'domain-c1'
+  assert inventory.resolve( '/Folder1/DC1/host/ClusterA/Resources/pool1' ) == 'resgroup-2'
+  assert inventory.resolve( '/Folder1/DC1/host/ClusterA/Resources/pool1/' ) == 'resgroup-2'
+  assert inventory.resolve( '/DC2/host/ClusterA' ) == 'domain-c2'
+  assert inventory.resolve( '/DC1' ) is None
+  assert inventory.get( 'domain-c1', 'resourcePool' ) == 'resgroup-1'
+
+
+def test_rename_invalidates_paths():
+  inventory = _loaded()
+  assert inventory.resolve( '/Folder1/DC1/host/ClusterA/Resources/pool1' ) == 'resgroup-2'
+
+  inventory._apply( _update( _modify( folder1, _change( 'name', 'Folder2' ) ) ) )
+  assert inventory.path_map is None
+  assert inventory.resolve( '/Folder1/DC1/host/ClusterA/Resources/pool1' ) is None
+  assert inventory.resolve( '/Folder2/DC1/host/ClusterA/Resources/pool1' ) == 'resgroup-2'
+  assert inventory.find( vim.Folder, 'Folder1' ) == []
+  assert inventory.find( vim.Folder, 'Folder2' ) == [ 'group-d2' ]
+
+  inventory._apply( _update( _modify( dc1, _change( 'parent', root ) ) ) )  # moved out of the folder
+  assert inventory.resolve( '/DC1/host/ClusterA' ) == 'domain-c1'
+
+
+def test_hot_property_keeps_paths():
+  inventory = _loaded()
+  inventory.resolve( '/DC2' )
+  inventory._apply( _update( _modify( cluster_a, _change( 'resourcePool', pool1 ) ) ) )
+  assert inventory.path_map is not None
+  assert inventory.get( 'domain-c1', 'resourcePool' ) == 'resgroup-2'
+
+
+def test_vms_keep_paths():
+  inventory = _loaded()
+  assert inventory.resolve( '/Folder1/DC1/vm/template' ) is None  # vms are not in the path index
+  assert inventory.path_map is not None
+
+  new_vm = vim.VirtualMachine( 'vm-3' )
+  inventory._apply( _update( _enter( new_vm, 'new', vm_folder1 ) ) )
+  assert inventory.path_map is not None
+  inventory._apply( _update( _modify( new_vm, _change( 'name', 'renamed' ) ) ) )
+  assert inventory.path_map is not None
+  inventory._apply( _update( _leave( new_vm ) ) )
+  assert inventory.path_map is not None
+  assert inventory.resolve( '/Folder1/DC1/host/ClusterA/Resources/pool1' ) == 'resgroup-2'
+
+
+def test_leave():
+  inventory = _loaded()
+  assert inventory.resolve( '/Folder1/DC1/host/ClusterA/Resources/pool1' ) == 'resgroup-2'
+
+  inventory._apply( _update( _leave( pool1 ) ) )
+  assert inventory.resolve( '/Folder1/DC1/host/ClusterA/Resources/pool1' ) is None
+  assert inventory.find( vim.ResourcePool, 'pool1' ) == []
+  assert inventory.get( 'resgroup-2', 'name' ) is None
+
+
+def test_find_within():
+  inventory = _loaded()
+  assert sorted( inventory.find( vim.VirtualMachine, 'template' ) ) == [ 'vm-1', 'vm-2' ]
+  assert inventory.find( vim.VirtualMachine, 'template', 'datacenter-1' ) == [ 'vm-1' ]
+  assert inventory.find( vim.VirtualMachine, 'template', 'datacenter-2' ) == [ 'vm-2' ]
+  assert inventory.find( vim.ComputeResource, 'ClusterA', 'datacenter-2' ) == [ 'domain-c2' ]  # sub types match
+  assert inventory.find( vim.Datacenter, 'ClusterA' ) == []
+  assert inventory.find( vim.VirtualMachine, 'other', 'datacenter-1' ) == []
@@ -6,12 +6,14 @@ import ssl
 from datetime import datetime, timedelta
 
 from pyVim import connect
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 
 from subcontractor.credentials import getCredentials
 from subcontractor_plugins.vcenter.images import OVAImportHandler, OVAExportHandler
+from subcontractor_plugins.vcenter.inventory import get_inventory
 
 POLL_INTERVAL = 4
+INSTANT_CLONE_MIN_API_VERSION = ( 6, 7 )
 BOOT_ORDER_MAP = {
                     'hdd': vim.vm.BootOptions.BootableDiskDevice( deviceKey=2000 ),  # TODO: figure out which is the boot drive and put it here
                     'net': vim.vm.BootOptions.BootableEthernetDevice( deviceKey=4000 ),  # TODO: figure out which is the provisinioning interface and set it here
@@ -19,6 +21,17 @@ BOOT_ORDER_MAP = {
                     'usb': 'USB'
                  }
 
+INVENTORY_PROPERTY_MAP = {
+                           vim.Folder: [],
+                           vim.Datacenter: [],
+                           vim.ComputeResource: [ 'host', 'resourcePool' ],
+                           vim.ResourcePool: [ 'owner' ],
+                           vim.HostSystem: [ 'datastore', 'network', 'summary.hardware.memorySize', 'summary.hardware.numCpuCores', 'summary.hardware.cpuMhz', 'summary.quickStats.overallMemoryUsage', 'summary.quickStats.overallCpuUsage' ],
+                           vim.Datastore: [ 'summary.freeSpace' ],
+                           vim.Network: [],
+                           vim.VirtualMachine: []
+                         }
+
 NET_CLASS_MAP = { 'E1000': vim.vm.device.VirtualE1000,
                   'E1000e': vim.vm.device.VirtualE1000e,
                   'PCNet32': vim.vm.device.VirtualPCNet32,
@@ -57,6 +70,32 @@ def _disconnect( si ):
   connect.Disconnect( si )
 
 
+def _getInventory( connection_paramaters ):
+  creds = connection_paramaters[ 'credentials' ]
+  key = ( connection_paramaters[ 'host' ], creds if isinstance( creds, str ) else creds.get( 'username', creds.get( 'token' ) ) )
+
+  return get_inventory( key, lambda: _connect( connection_paramaters ), _disconnect, INVENTORY_PROPERTY_MAP )
+
+
+def _retrieveNames( si, container, vim_type ):
+  # all the names of vim_type objects in container in one retrieval, returns a list of ( MoRef, name )
+  view = si.content.viewManager.CreateContainerView( container, [ vim_type ], True )
+  try:
+    traversal = vmodl.query.PropertyCollector.TraversalSpec( name='traverseView', path='view', skip=False, type=vim.view.ContainerView )
+    spec = vmodl.query.PropertyCollector.FilterSpec()
+    spec.objectSet = [ vmodl.query.PropertyCollector.ObjectSpec( obj=view, skip=True, selectSet=[ traversal ] ) ]
+    spec.propSet = [ vmodl.query.PropertyCollector.PropertySpec( type=vim_type, pathSet=[ 'name' ] ) ]
+
+    result = []
+    for item in si.content.propertyCollector.RetrieveContents( [ spec ] ):
+      result.append( ( item.obj, item.propSet[0].val ) )
+
+    return result
+
+  finally:
+    view.DestroyView()
+
+
 def _taskWait( task ):
   while True:
     if task.info.state not in ( 'running', 'queued' ):
@@ -75,26 +114,90 @@ def _taskWait( task ):
     time.sleep( POLL_INTERVAL )
 
 
-def _getDatacenter( si, name ):
-  for item in si.content.rootFolder.childEntity:
-    if item.__class__.__name__ == 'vim.Datacenter' and item.name == name:
+def _taskWaitAll( task_list ):
+  # wait for a group of tasks that were submitted together, the caller then checks each task state
+  while True:
+    waiting = len( [ task for task in task_list if task.info.state in ( 'running', 'queued' ) ] )
+    if not waiting:
+      return
+
+    logging.debug( 'vmware: Waiting on {0} of {1} tasks ...'.format( waiting, len( task_list ) ) )
+
+    time.sleep( POLL_INTERVAL )
+
+
+def _api_version( si ):
+  return tuple( int( i ) for i in si.content.about.apiVersion.split( '.' ) if i.isdigit() )
+
+
+def _resolvePath( si, path, inventory=None ):
+  # path is an inventory path, ie: '/DC1/host/ClusterA/Resources/pool1', returns None if nothing is there
+  if inventory is not None:
+    moId = inventory.resolve( path )
+    if moId is not None:
+      return inventory.bind( si, moId )
+
+  return si.content.searchIndex.FindByInventoryPath( path.strip( '/' ) )
+
+
+def _getDatacenter( si, name, inventory=None ):  # name can also be an inventory path, ie: '/Folder1/DC1'
+  if name.startswith( '/' ):
+    item = _resolvePath( si, name, inventory )
+    if isinstance( item, vim.Datacenter ):
+      return item
+
+    raise MOBNotFound( 'Datacenter "{0}" not found'.format( name ) )
+
+  if inventory is not None:
+    moId_list = inventory.find( vim.Datacenter, name )
+    if len( moId_list ) == 1:
+      return inventory.bind( si, moId_list[0] )
+
+  for item, item_name in _retrieveNames( si, si.content.rootFolder, vim.Datacenter ):  # includes the datacenters in folders
+    if item_name == name:
       return item
 
   raise MOBNotFound( 'Datacenter "{0}" not found'.format( name ) )
 
 
-def _getResourcePool( dc, name ):  # TODO: recursive folder search
-  for item in dc.hostFolder.childEntity:
-    if item.__class__.__name__ in ( 'vim.ComputeResource', 'vim.ClusterComputeResource' ) and item.name == name:
+def _getResourcePool( si, dc, name, inventory=None ):  # name can also be an inventory path, ie: '/DC1/host/ClusterA/Resources/pool1'
+  if name.startswith( '/' ):
+    item = _resolvePath( si, name, inventory )
+    if isinstance( item, vim.ComputeResource ):
+      return item.resourcePool
+
+    if isinstance( item, vim.ResourcePool ):
+      return item
+
+    raise MOBNotFound( 'Cluster/ResourcePool "{0}" not found'.format( name ) )
+
+  if inventory is not None:
+    moId_list = inventory.find( vim.ComputeResource, name, dc._moId )
+    if len( moId_list ) == 1 and inventory.get( moId_list[0], 'resourcePool' ) is not None:
+      return inventory.bind( si, inventory.get( moId_list[0], 'resourcePool' ) )
+
+    moId_list = inventory.find( vim.ResourcePool, name, dc._moId )
+    if len( moId_list ) == 1:
+      return inventory.bind( si, moId_list[0] )
+
+  # the views are recursive, so clusters in folders and nested resource pools are found
+  for item, item_name in _retrieveNames( si, dc.hostFolder, vim.ComputeResource ):
+    if item_name == name:
       return item.resourcePool
 
-    if item.__class__.__name__ in ( 'vim.ResourcePool', ) and item.name == name:
+  for item, item_name in _retrieveNames( si, dc.hostFolder, vim.ResourcePool ):
+    if item_name == name:
       return item
 
   raise MOBNotFound( 'Cluster/ResourcePool "{0}" not found'.format( name ) )
 
 
-def _getHost( rp, name ):
+def _getHost( rp, name, inventory=None ):
+  if inventory is not None:
+    for moId in inventory.get( inventory.get( rp._moId, 'owner' ), 'host' ) or []:
+      if inventory.get( moId, 'name' ) == name:
+        return inventory.bind( rp, moId )
+
   for host in rp.owner.host:
     if host.name == name:
       return host
@@ -102,7 +205,12 @@ def _getHost( rp, name ):
   raise MOBNotFound( 'Host "{0}" in "{1}" not found'.format( name, rp.name ) )
 
 
-def _getDatastore( dc, name ):
+def _getDatastore( dc, name, inventory=None ):
+  if inventory is not None:
+    moId_list = inventory.find( vim.Datastore, name, dc._moId )
+    if len( moId_list ) == 1:
+      return inventory.bind( dc, moId_list[0] )
+
   for ds in dc.datastore:
     if ds.name == name:
       return ds
@@ -110,7 +218,12 @@ def _getDatastore( dc, name ):
   raise MOBNotFound( 'Datastore "{0}" in "{1}" not found'.format( name, dc.name ) )
 
 
-def _getNetwork( host, name ):
+def _getNetwork( host, name, inventory=None ):
+  if inventory is not None:
+    for moId in inventory.get( host._moId, 'network' ) or []:
+      if inventory.get( moId, 'name' ) == name:
+        return inventory.bind( host, moId )
+
   for network in host.network:
     if network.name == name:
       return network
@@ -118,6 +231,68 @@ def _getNetwork( host, name ):
   raise MOBNotFound( 'Network "{0}" in "{1}" not found'.format( name, host.name ) )
 
 
+def _hostSummaryList( rp, inventory=None ):
+  # returns a list of dicts with the name, memory and cpu summary of the hosts in the resource pool's cluster
+  if inventory is not None:
+    moId_list = inventory.get( inventory.get( rp._moId, 'owner' ), 'host' )
+    if moId_list is not None:
+      return [ {
+                 'name': inventory.get( moId, 'name' ),
+                 'memory_size': inventory.get( moId, 'summary.hardware.memorySize' ),
+                 'memory_usage': inventory.get( moId, 'summary.quickStats.overallMemoryUsage' ),
+                 'cpu_cores': inventory.get( moId, 'summary.hardware.numCpuCores' ),
+                 'cpu_mhz': inventory.get( moId, 'summary.hardware.cpuMhz' ),
+                 'cpu_usage': inventory.get( moId, 'summary.quickStats.overallCpuUsage' )
+               } for moId in moId_list ]
+
+  result = []
+  for host in rp.owner.host:
+    summary = host.summary
+    result.append( {
+                     'name': host.name,
+                     'memory_size': summary.hardware.memorySize,
+                     'memory_usage': summary.quickStats.overallMemoryUsage,
+                     'cpu_cores': summary.hardware.numCpuCores,
+                     'cpu_mhz': summary.hardware.cpuMhz,
+                     'cpu_usage': summary.quickStats.overallCpuUsage
+                   } )
+
+  return result
+
+
+def _datastoreList( host, inventory=None ):
+  # returns a list of ( name, free space in bytes ) of the datastores attached to the host
+  if inventory is not None:
+    moId_list = inventory.get( host._moId, 'datastore' )
+    if moId_list is not None:
+      return [ ( inventory.get( moId, 'name' ), inventory.get( moId, 'summary.freeSpace' ) ) for moId in moId_list ]
+
+  return [ ( datastore.name, datastore.summary.freeSpace ) for datastore in host.datastore ]
+
+
+def _networkNameList( host, inventory=None ):
+  if inventory is not None:
+    moId_list = inventory.get( host._moId, 'network' )
+    if moId_list is not None:
+      return [ inventory.get( moId, 'name' ) for moId in moId_list ]
+
+  return [ network.name for network in host.network ]
+
+
+def _getVMByName( si, inventory, dc, name ):
+  if inventory is not None:
+    moId_list = inventory.find( vim.VirtualMachine, name, dc._moId )
+    if len( moId_list ) == 1:
+      return inventory.bind( si, moId_list[0] )
+
+  # not indexed, just created, or the name is used more than once in the datacenter, ask the datacenter
+  for item, item_name in _retrieveNames( si, dc, vim.VirtualMachine ):
+    if item_name == name:
+      return item
+
+  raise MOBNotFound( 'vcenter: unable to find vm "{0}"'.format( name ) )
+
+
 def _getVM( si, vm_uuid ):
   cont = si.RetrieveContent()
   vm = cont.searchIndex.FindByUuid( None, vm_uuid, True, True )
@@ -162,24 +337,25 @@ def host_list( paramaters ):
   logging.info( 'vcenter: getting Host List for dc: "{0}"  rp: "{1}"'.format( paramaters[ 'datacenter' ], paramaters[ 'cluster' ] ) )
   si = _connect( connection_paramaters )
   try:
-    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ] )
-    resourcePool = _getResourcePool( dataCenter, paramaters[ 'cluster' ] )
+    inventory = _getInventory( connection_paramaters )
+    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ], inventory )
+    resourcePool = _getResourcePool( si, dataCenter, paramaters[ 'cluster' ], inventory )
 
     host_map = {}
-    for host in resourcePool.owner.host:
-      if host.summary.quickStats.overallMemoryUsage is None:  # sometimes the quickstats don't get updated, for now skip that host
+    for host in _hostSummaryList( resourcePool, inventory ):
+      if host[ 'memory_usage' ] is None:  # sometimes the quickstats don't get updated, for now skip that host
         continue
 
-      total_memory = host.summary.hardware.memorySize / 1024.0 / 1024.0
-      memory_aviable = total_memory - host.summary.quickStats.overallMemoryUsage
+      total_memory = host[ 'memory_size' ] / 1024.0 / 1024.0
+      memory_aviable = total_memory - host[ 'memory_usage' ]
       if memory_aviable < paramaters[ 'min_memory' ]:
-        logging.debug( 'vcenter: host "{0}", low aviable ram: "{1}"'.format( host.name, memory_aviable ) )
+        logging.debug( 'vcenter: host "{0}", low aviable ram: "{1}"'.format( host[ 'name' ], memory_aviable ) )
         continue
 
-      total_cpu = host.summary.hardware.numCpuCores * host.summary.hardware.cpuMhz
-      cpu_aviable = total_cpu - host.summary.quickStats.overallCpuUsage
+      total_cpu = host[ 'cpu_cores' ] * host[ 'cpu_mhz' ]
+      cpu_aviable = total_cpu - ( host[ 'cpu_usage' ] or 0 )
 
-      host_map[ host.name ] = ( paramaters[ 'memory_scaler' ] * ( memory_aviable / total_memory ) ) + ( paramaters[ 'cpu_scaler' ] * ( cpu_aviable / total_cpu ) )
+      host_map[ host[ 'name' ] ] = ( paramaters[ 'memory_scaler' ] * ( memory_aviable / total_memory ) ) + ( paramaters[ 'cpu_scaler' ] * ( cpu_aviable / total_cpu ) )
 
     logging.debug( 'vcenter: host_map {0}'.format( host_map ) )
 
@@ -197,9 +373,10 @@ def create_datastore( paramaters ):
   logging.info( 'vcenter: creating datastores: "{0}"'.format( paramaters[ 'name' ] ) )
   si = _connect( connection_paramaters )
   try:
-    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ] )
-    resourcePool = _getResourcePool( dataCenter, paramaters[ 'host' ] )
-    host = _getHost( resourcePool, paramaters[ 'host' ] )
+    inventory = _getInventory( connection_paramaters )
+    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ], inventory )
+    resourcePool = _getResourcePool( si, dataCenter, paramaters[ 'host' ], inventory )
+    host = _getHost( resourcePool, paramaters[ 'host' ], inventory )
 
     dss = host.configManager.datastoreSystem
     ss = host.configManager.storageSystem
@@ -243,19 +420,20 @@ def datastore_list( paramaters ):
 
   si = _connect( connection_paramaters )
   try:
-    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ] )
-    resourcePool = _getResourcePool( dataCenter, paramaters[ 'cluster' ] )
-    host = _getHost( resourcePool, paramaters[ 'host' ] )
+    inventory = _getInventory( connection_paramaters )
+    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ], inventory )
+    resourcePool = _getResourcePool( si, dataCenter, paramaters[ 'cluster' ], inventory )
+    host = _getHost( resourcePool, paramaters[ 'host' ], inventory )
 
     result = []
-    for datastore in host.datastore:
-      if datastore.summary.freeSpace / 1024.0 / 1024.0 / 1024.0 < paramaters[ 'min_free_space' ]:
+    for name, free_space in _datastoreList( host, inventory ):
+      if free_space / 1024.0 / 1024.0 / 1024.0 < paramaters[ 'min_free_space' ]:
         continue
 
-      if paramaters[ 'name_regex' ] is not None and not paramaters[ 'name_regex' ].match( datastore.name ):
+      if paramaters[ 'name_regex' ] is not None and not paramaters[ 'name_regex' ].match( name ):
         continue
 
-      result.append( datastore.name )
+      result.append( name )
 
     return { 'datastore_list': result }
 
@@ -274,16 +452,17 @@ def network_list( paramaters ):
 
   si = _connect( connection_paramaters )
   try:
-    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ] )
-    resourcePool = _getResourcePool( dataCenter, paramaters[ 'cluster' ] )
-    host = _getHost( resourcePool, paramaters[ 'host' ] )
+    inventory = _getInventory( connection_paramaters )
+    dataCenter = _getDatacenter( si, paramaters[ 'datacenter' ], inventory )
+    resourcePool = _getResourcePool( si, dataCenter, paramaters[ 'cluster' ], inventory )
+    host = _getHost( resourcePool, paramaters[ 'host' ], inventory )
 
     result = []
-    for network in host.network:
-      if paramaters[ 'name_regex' ] is not None and not paramaters[ 'name_regex' ].match( network.name ):
+    for name in _networkNameList( host, inventory ):
+      if paramaters[ 'name_regex' ] is not None and not paramaters[ 'name_regex' ].match( name ):
         continue
 
-      result.append( network.name )
+      result.append( name )
 
     return { 'network_list': result }
 
@@ -291,9 +470,7 @@ def network_list( paramaters ):
     _disconnect( si )
 
 
-def _createDisk( si, dc, disk, datastore, file_path ):
-  ( dir_name, _ ) = file_path.rsplit( '/', 1 )
-
+def _makeDirectory( si, dc, datastore, dir_name ):
   spec = vim.host.DatastoreBrowser.SearchSpec()
   spec.query.append( vim.host.DatastoreBrowser.FolderQuery() )
   task = datastore.browser.SearchDatastore_Task( datastorePath=dir_name, searchSpec=spec )
@@ -309,21 +486,33 @@ def _createDisk( si, dc, disk, datastore, file_path ):
   elif task.info.state != 'success':
     raise Exception( 'Unexpected Task State when checking directory: "{0}"'.format( task.info.state ) )
 
-  spec = vim.VirtualDiskManager.FileBackedVirtualDiskSpec()
-  spec.diskType = disk.get( 'type', 'thin' )  # 'thin', 'eagerZeroedThick', 'preallocate'
-  spec.adapterType = disk.get( 'adapter', 'busLogic' )  # 'busLogic', 'ide', 'lsiLogic'
-  spec.capacityKb = disk.get( 'size', 10 ) * 1024 * 1024
 
-  logging.debug( 'vcenter: creating disk "{0}"'.format( file_path ) )
+def _createDisks( si, dc, disk_list, datastore, file_path_list ):
+  # the disks are all created at the same time, so this takes as long as the slowest disk, not the sum of them (eagerZeroedThick disks can take minutes each)
+  for dir_name in set( file_path.rsplit( '/', 1 )[0] for file_path in file_path_list ):
+    _makeDirectory( si, dc, datastore, dir_name )
 
-  task = si.content.virtualDiskManager.CreateVirtualDisk( name=file_path, datacenter=dc, spec=spec )
-  _taskWait( task )
+  task_list = []
+  for i in range( 0, len( disk_list ) ):
+    disk = disk_list[ i ]
+    spec = vim.VirtualDiskManager.FileBackedVirtualDiskSpec()
+    spec.diskType = disk.get( 'type', 'thin' )  # 'thin', 'eagerZeroedThick', 'preallocate'
+    spec.adapterType = disk.get( 'adapter', 'busLogic' )  # 'busLogic', 'ide', 'lsiLogic'
+    spec.capacityKb = disk.get( 'size', 10 ) * 1024 * 1024
 
-  if task.info.state == 'error':
-    raise Exception( 'Unknown Task Error when Creating Disk: "{0}"'.format( task.info.error ) )
+    logging.debug( 'vcenter: creating disk "{0}"'.format( file_path_list[ i ] ) )
 
-  if task.info.state != 'success':
-    raise Exception( 'Unexpected Task State when Creating Disk: "{0}"'.format( task.info.state ) )
+    task_list.append( si.content.virtualDiskManager.CreateVirtualDisk( name=file_path_list[ i ], datacenter=dc, spec=spec ) )
+
+  _taskWaitAll( task_list )
+
+  for i in range( 0, len( task_list ) ):
+    task = task_list[ i ]
+    if task.info.state == 'error':
+      raise Exception( 'Unknown Task Error when Creating Disk "{0}": "{1}"'.format( file_path_list[ i ], task.info.error ) )
+
+    if task.info.state != 'success':
+      raise Exception( 'Unexpected Task State when Creating Disk "{0}": "{1}"'.format( file_path_list[ i ], task.info.state ) )
 
 
 def _inject_ovf_env( si, vm, vm_paramaters ):
@@ -382,17 +571,35 @@ def _inject_ovf_env( si, vm, vm_paramaters ):
     raise Exception( 'Unexpected Task State With OVF Environment Injection: "{0}"'.format( task.info.state ) )
 
 
-def _create_from_template( si, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
-  logging.info( 'vcenter: creating from Template("{0}") "{1}"'.format( vm_paramaters[ 'template' ], vm_name ) )
+def _instantCloneGuestInfo( vm_paramaters ):
+  # an instant clone starts as a copy of the running parent, with the parent's hostname and addresses, what the
+  # customization spec would have set is passed as guestinfo for the guest to apply before its network is reconnected
+  result = {}
+  result[ 'guestinfo.hostname' ] = vm_paramaters[ 'hostname' ]
+  result[ 'guestinfo.domain' ] = vm_paramaters[ 'domain' ]
+  result[ 'guestinfo.dnsserver_list' ] = ','.join( vm_paramaters[ 'dnsserver_list' ] )
+  result[ 'guestinfo.dnssuffix_list' ] = ','.join( vm_paramaters[ 'dnssuffix_list' ] )
+
+  for i in range( 0, len( vm_paramaters[ 'interface_list' ] ) ):
+    interface = vm_paramaters[ 'interface_list' ][ i ]
+    result[ 'guestinfo.interface.{0}.mac'.format( i ) ] = interface[ 'mac' ]
+    result[ 'guestinfo.interface.{0}.address'.format( i ) ] = interface[ 'address' ]
+    result[ 'guestinfo.interface.{0}.netmask'.format( i ) ] = interface[ 'netmask' ]
+    if 'gateway' in interface:
+      result[ 'guestinfo.interface.{0}.gateway'.format( i ) ] = interface[ 'gateway' ]
+
+  for key, value in ( vm_paramaters.get( 'property_map', None ) or {} ).items():
+    result[ 'guestinfo.{0}'.format( key ) ] = value
+
+  return result
 
-  template = None
-  cont = si.RetrieveContent()
-  for item in cont.viewManager.CreateContainerView( data_center, [ vim.VirtualMachine ], True ).view:
-    if item.name == vm_paramaters[ 'template' ]:
-      template = item
-      break
 
-  if template is None:
+def _create_from_template( si, inventory, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
+  logging.info( 'vcenter: creating from Template("{0}") "{1}"'.format( vm_paramaters[ 'template' ], vm_name ) )
+
+  try:
+    template = _getVMByName( si, inventory, data_center, vm_paramaters[ 'template' ] )
+  except MOBNotFound:
     raise MOBNotFound( 'vcenter: unable to find template "{0}"'.format( vm_paramaters[ 'template' ] ) )
 
   network_device_list = []
@@ -415,7 +622,7 @@ def _create_from_template( si, vm_name, data_center, resource_pool, folder, host
 
   for i in range( 0, len( vm_paramaters[ 'interface_list' ] ) ):
     interface = vm_paramaters[ 'interface_list' ][ i ]
-    network = _getNetwork( host, interface[ 'network' ] )
+    network = _getNetwork( host, interface[ 'network' ], inventory )
 
     devSpec = vim.vm.device.VirtualDeviceSpec()
     devSpec.operation = 'edit'
@@ -459,14 +666,45 @@ def _create_from_template( si, vm_name, data_center, resource_pool, folder, host
   reloSpec.host = host
   reloSpec.pool = resource_pool
 
-  cloneSpec = vim.vm.CloneSpec()
-  cloneSpec.config = configSpec
-  cloneSpec.location = reloSpec
-  cloneSpec.customization = customSpec
-  cloneSpec.powerOn = False
-  cloneSpec.template = False
+  clone_mode = vm_paramaters.get( 'clone_mode', 'full' )
+  if clone_mode == 'instant':  # forks the running source vm, the customization spec can't be applied, the guest re-identifies itself from guestinfo
+    if _api_version( si ) < INSTANT_CLONE_MIN_API_VERSION:
+      raise ValueError( 'Instant clone requires vSphere API "{0}" or newer, found "{1}"'.format( '.'.join( str( i ) for i in INSTANT_CLONE_MIN_API_VERSION ), si.content.about.apiVersion ) )
+
+    if template.runtime.powerState != vim.VirtualMachinePowerState.poweredOn:
+      raise ValueError( 'Instant clone source "{0}" must be a powered on vm, it is "{1}"'.format( vm_paramaters[ 'template' ], template.runtime.powerState ) )
+
+    reloSpec.folder = folder
+    reloSpec.deviceChange = configSpec.deviceChange
+
+    instantSpec = vim.vm.InstantCloneSpec()
+    instantSpec.name = vm_name
+    instantSpec.location = reloSpec
+    for key, value in _instantCloneGuestInfo( vm_paramaters ).items():
+      instantSpec.config.append( vim.option.OptionValue( key=key, value=value ) )
+
+    task = template.InstantClone_Task( spec=instantSpec )
+
+  elif clone_mode in ( 'full', 'linked' ):
+    cloneSpec = vim.vm.CloneSpec()
+    cloneSpec.config = configSpec
+    cloneSpec.location = reloSpec
+    cloneSpec.customization = customSpec
+    cloneSpec.powerOn = False
+    cloneSpec.template = False
+
+    if clone_mode == 'linked':  # the new vm's disks are children of the template's snapshot, no disk data is copied
+      if template.snapshot is None or template.snapshot.currentSnapshot is None:
+        raise ValueError( 'Template "{0}" has no snapshot to make a linked clone from'.format( vm_paramaters[ 'template' ] ) )
+
+      reloSpec.diskMoveType = 'createNewChildDiskBacking'
+      cloneSpec.snapshot = template.snapshot.currentSnapshot
+
+    task = template.Clone( folder=folder, name=vm_name, spec=cloneSpec )
+
+  else:
+    raise ValueError( 'Unknown clone mode "{0}"'.format( clone_mode ) )
 
-  task = template.Clone( folder=folder, name=vm_name, spec=cloneSpec )
   _taskWait( task )
 
   if task.info.state == 'error':
@@ -478,7 +716,7 @@ def _create_from_template( si, vm_name, data_center, resource_pool, folder, host
   return task.info.result.config.instanceUuid
 
 
-def _create_from_ova( si, vm_name, connection_host, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
+def _create_from_ova( si, inventory, vm_name, connection_host, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
   logging.info( 'vcenter: creating from OVA("{0}") "{1}"'.format( vm_paramaters[ 'ova' ], vm_name ) )
   if hasattr( ssl, '_create_unverified_context' ):
     sslContext = ssl._create_unverified_context()
@@ -491,7 +729,7 @@ def _create_from_ova( si, vm_name, connection_host, data_center, resource_pool,
 
   network_mapping = []
   for interface in vm_paramaters[ 'interface_list' ]:
-    network_mapping.append( vim.OvfManager.NetworkMapping( name=interface[ 'physical_location' ], network=_getNetwork( host, interface[ 'network' ] ) ) )
+    network_mapping.append( vim.OvfManager.NetworkMapping( name=interface[ 'physical_location' ], network=_getNetwork( host, interface[ 'network' ], inventory ) ) )
 
   property_map = []
   try:
@@ -542,13 +780,12 @@ def _create_from_ova( si, vm_name, connection_host, data_center, resource_pool,
   return uuid
 
 
-def _create_from_scratch( si, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
+def _create_from_scratch( si, inventory, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters ):
   logging.info( 'vcenter: creating from scratch "{0}"'.format( vm_name ) )
 
   vmx_file_path, disk_filepath_list = _genPaths( vm_paramaters[ 'name' ], vm_paramaters[ 'disk_list' ], datastore )
 
-  for i in range( 0, len( vm_paramaters[ 'disk_list' ] ) ):
-    _createDisk( si, data_center, vm_paramaters[ 'disk_list' ][ i ], datastore, disk_filepath_list[ i ] )
+  _createDisks( si, data_center, vm_paramaters[ 'disk_list' ], datastore, disk_filepath_list )
 
   configSpec = vim.vm.ConfigSpec()
   configSpec.name = vm_name
@@ -593,7 +830,7 @@ def _create_from_scratch( si, vm_name, data_center, resource_pool, folder, host,
 
   for i in range( 0, len( vm_paramaters[ 'interface_list' ] ) ):
     interface = vm_paramaters[ 'interface_list' ][ i ]
-    network = _getNetwork( host, interface[ 'network' ] )
+    network = _getNetwork( host, interface[ 'network' ], inventory )
 
     try:
       devClass = NET_CLASS_MAP[ interface.get( 'type', 'E1000' ) ]
@@ -676,18 +913,19 @@ def create( paramaters ):  # NOTE: the picking of the cluster/host and datastore
   logging.info( 'vcenter: creating vm "{0}"'.format( vm_name ) )
   si = _connect( connection_paramaters )
   try:
-    data_center = _getDatacenter( si, vm_paramaters[ 'datacenter' ] )
-    resource_pool = _getResourcePool( data_center, vm_paramaters[ 'cluster' ] )
+    inventory = _getInventory( connection_paramaters )
+    data_center = _getDatacenter( si, vm_paramaters[ 'datacenter' ], inventory )
+    resource_pool = _getResourcePool( si, data_center, vm_paramaters[ 'cluster' ], inventory )
     folder = data_center.vmFolder
-    host = _getHost( resource_pool, vm_paramaters[ 'host' ] )
-    datastore = _getDatastore( data_center, vm_paramaters[ 'datastore' ] )
+    host = _getHost( resource_pool, vm_paramaters[ 'host' ], inventory )
+    datastore = _getDatastore( data_center, vm_paramaters[ 'datastore' ], inventory )
 
     if 'ova' in vm_paramaters:
-      vm_uuid = _create_from_ova( si, vm_name, paramaters[ 'connection' ][ 'host' ], data_center, resource_pool, folder, host, datastore, vm_paramaters )
+      vm_uuid = _create_from_ova( si, inventory, vm_name, paramaters[ 'connection' ][ 'host' ], data_center, resource_pool, folder, host, datastore, vm_paramaters )
     elif 'template' in vm_paramaters:
-      vm_uuid = _create_from_template( si, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters )
+      vm_uuid = _create_from_template( si, inventory, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters )
     else:
-      vm_uuid = _create_from_scratch( si, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters )
+      vm_uuid = _create_from_scratch( si, inventory, vm_name, data_center, resource_pool, folder, host, datastore, vm_paramaters )
 
     logging.info( 'vcenter: vm "{0}" created, uuid: "{1}"'.format( vm_name, vm_uuid ) )
 
@@ -697,6 +935,26 @@ def create( paramaters ):  # NOTE: the picking of the cluster/host and datastore
     _disconnect( si )
 
 
+def _deleteFiles( si, dc, file_list ):
+  task_list = []
+  for item in file_list:  # submit them all, then wait for them together
+    logging.debug( 'vcenter: deleting "{0}"'.format( item ) )
+    task_list.append( si.content.fileManager.DeleteFile( name=item, datacenter=dc ) )
+
+  _taskWaitAll( task_list )
+
+  for i in range( 0, len( task_list ) ):
+    task = task_list[ i ]
+    if task.info.state == 'error':
+      if task.info.error.__class__.__name__ == 'vim.fault.FileNotFound':  # never created, or allready removed with its descriptor
+        continue
+      else:
+        raise Exception( 'Unknown Task Error when Deleting "{0}": "{1}"'.format( file_list[ i ], task.info.error ) )
+
+    if task.info.state != 'success':
+      raise Exception( 'Unexpected Task State when Deleting "{0}": "{1}"'.format( file_list[ i ], task.info.state ) )
+
+
 def create_rollback( paramaters ):
   vm_paramaters = paramaters[ 'vm' ]
   connection_paramaters = paramaters[ 'connection' ]
@@ -705,25 +963,17 @@ def create_rollback( paramaters ):
 
   si = _connect( connection_paramaters )
   try:
-    dataCenter = _getDatacenter( si, vm_paramaters[ 'datacenter' ] )
-    datastore = _getDatastore( dataCenter, vm_paramaters[ 'datastore' ] )
+    inventory = _getInventory( connection_paramaters )
+    dataCenter = _getDatacenter( si, vm_paramaters[ 'datacenter' ], inventory )
+    datastore = _getDatastore( dataCenter, vm_paramaters[ 'datastore' ], inventory )
 
     vmx_file_path, disk_filepath_list = _genPaths( vm_paramaters[ 'name' ], vm_paramaters[ 'disk_list' ], datastore )
 
-    file_list = disk_filepath_list + [ i.replace( '.vmdk', '-flat.vmdk' ) for i in disk_filepath_list ] + [ vmx_file_path ]
-
-    for item in file_list:
-      logging.debug( 'vcenter: deleting "{0}"'.format( item ) )
-      task = si.content.fileManager.DeleteFile( name=item, datacenter=dataCenter )
-      _taskWait( task )
-      if task.info.state == 'error':
-        if task.info.error.__class__.__name__ == 'vim.fault.FileNotFound':
-          continue
-        else:
-          raise Exception( 'Unknown Task Error when Deleting "{0}": "{1}"'.format( item, task.info.error ) )
-
-      if task.info.state != 'success':
-        raise Exception( 'Unexpected Task State when Deleting "{0}": "{1}"'.format( task.info.state ) )
+    # deleting a descriptor through the FileManager also removes its flat file, so the descriptors
+    # (and the vmx) go first, all at once, then what is left of the flat files, the two groups must
+    # not overlap or the deletes race on the same flat file
+    _deleteFiles( si, dataCenter, disk_filepath_list + [ vmx_file_path ] )
+    _deleteFiles( si, dataCenter, [ i.replace( '.vmdk', '-flat.vmdk' ) for i in disk_filepath_list ] )
 
     # remove all the folders if empty
 
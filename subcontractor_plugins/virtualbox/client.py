@@ -1,13 +1,23 @@
 import zeep
 import logging
+import os
 import socket
 import re
+import stat
+import threading
 from urllib import request
+from zeep.cache import SqliteCache
+from zeep.transports import Transport
 
 VBOX_SOAP_BINDING = '{http://www.virtualbox.org/}vboxBinding'
 
 VBOX_E_OBJECT_NOT_FOUND = '0x80bb0001'
 
+WSDL_CACHE_DIR = '/var/cache/subcontractor/virtualbox'  # set to None to not cache the wsdl on disk, must be owned by this user and not accessible by others
+
+_service_cache = {}  # host -> ( client, service )
+_service_cache_lock = threading.Lock()
+
 
 class VirtualBoxNotFound( Exception ):
   pass
@@ -21,30 +31,81 @@ def error_rc( e ):
   return parts.group( 1 ).lower()
 
 
-def soap_property( object, name, readonly=False ):
-  if readonly:
-    return property(
-                     lambda self: getattr( self.service, '{0}_get{1}'.format( object, name ) )( self.handle ),
-                   )
-  else:
-    return property(
-                     lambda self: getattr( self.service, '{0}_get{1}'.format( object, name ) )( self.handle ),
-                     lambda self, value: getattr( self.service, '{0}_set{1}'.format( object, name ) )( self.handle, value )
-                   )
+class soap_property():
+  # immutable values are kept in the object's snapshot the first time they are read, after
+  # that they are served without a SOAP call
+  def __init__( self, object, name, readonly=False, immutable=False ):
+    self.object = object
+    self.name = name
+    self.readonly = readonly
+    self.immutable = immutable
 
+  def fetch( self, instance ):
+    return getattr( instance.service, '{0}_get{1}'.format( self.object, self.name ) )( instance.handle )
 
-class VirtualBox:
-  def __init__( self, host, username, password, proxy=None ):
-    if not host.startswith( ( 'http:', 'https:' ) ):
-      raise ValueError( 'hostname must start with http(s):' )
+  def __get__( self, instance, owner ):
+    if instance is None:
+      return self
 
-    if host[-1] != '/':
-      raise ValueError( 'hostname must end with "/"' )
+    try:
+      return instance._snapshot[ self.name ]
+    except KeyError:
+      pass
 
-    logging.debug( 'virtualbox: new client host: "{0}", via: "{1}"'.format( host, proxy ) )
+    value = self.fetch( instance )
+    if self.immutable:
+      instance._snapshot[ self.name ] = value
+
+    return value
+
+  def __set__( self, instance, value ):
+    if self.readonly:
+      raise AttributeError( '"{0}" is readonly'.format( self.name ) )
+
+    getattr( instance.service, '{0}_set{1}'.format( self.object, self.name ) )( instance.handle, value )
+    instance._snapshot.pop( self.name, None )
+
+
+def _cache_dir_ok():
+  # zeep loads whatever is in the cache without expiring it, so only use a directory we own that no one else can write to
+  if WSDL_CACHE_DIR is None:
+    return False
+
+  try:
+    os.makedirs( WSDL_CACHE_DIR, mode=0o700, exist_ok=True )
+    dir_stat = os.lstat( WSDL_CACHE_DIR )
+  except OSError as e:
+    logging.warning( 'virtualbox: unable to create wsdl cache dir "{0}", not caching: "{1}"'.format( WSDL_CACHE_DIR, e ) )
+    return False
+
+  if not stat.S_ISDIR( dir_stat.st_mode ) or dir_stat.st_uid != os.geteuid() or dir_stat.st_mode & 0o077:
+    logging.warning( 'virtualbox: wsdl cache dir "{0}" is not a directory owned by us with mode 0700, not caching'.format( WSDL_CACHE_DIR ) )
+    return False
+
+  return True
+
+
+def _cache_path( host, extension ):
+  return os.path.join( WSDL_CACHE_DIR, '{0}.{1}'.format( re.sub( '[^a-zA-Z0-9_.-]', '_', host ), extension ) )
 
+
+def _get_service( host ):
+  # the wsdl and its schemas are kept on disk (without expiring, see _check_api_version), and the
+  # compiled client/service is kept for the life of the process, both are per host
+  with _service_cache_lock:
     try:
-      self.client = zeep.Client( '{0}?wsdl'.format( host ) )
+      return _service_cache[ host ]
+    except KeyError:
+      pass
+
+    location = '{0}?wsdl'.format( host )
+    if _cache_dir_ok():
+      transport = Transport( cache=SqliteCache( path=_cache_path( host, 'db' ), timeout=None ) )
+    else:
+      transport = Transport()
+
+    try:
+      client = zeep.Client( location, transport=transport )
 
     except request.HTTPError as e:
       raise Exception( 'HTTPError "{0}"'.format( e ) )
@@ -55,26 +116,109 @@ class VirtualBox:
     except socket.error as e:
       raise Exception( 'Socket Error "{0}"'.format( e ) )
 
+    service = client.create_service( VBOX_SOAP_BINDING, location )
+    _service_cache[ host ] = ( client, service )
+
+    return client, service
+
+
+def _flush_service( host ):
+  with _service_cache_lock:
+    _service_cache.pop( host, None )
+    if WSDL_CACHE_DIR is None:
+      return
+
+    for extension in ( 'db', 'version' ):
+      try:
+        os.unlink( _cache_path( host, extension ) )
+      except FileNotFoundError:
+        pass
+
+
+class SOAPObject:
+  def __init__( self, service, handle ):
+    self.service = service
+    self.handle = handle
+    self._snapshot = {}
+
+
+class VirtualBox:
+  def __init__( self, host, username, password, proxy=None ):
+    if not host.startswith( ( 'http:', 'https:' ) ):
+      raise ValueError( 'hostname must start with http(s):' )
+
+    if host[-1] != '/':
+      raise ValueError( 'hostname must end with "/"' )
+
+    logging.debug( 'virtualbox: new client host: "{0}", via: "{1}"'.format( host, proxy ) )
+
+    self.host = host
+    self.username = username
+    self.password = password
+
     self.location = '{0}?wsdl'.format( host )
-    self.service = self.client.create_service( VBOX_SOAP_BINDING, self.location )
+    self.client, self.service = _get_service( host )
+    self.logon()
+    self._check_api_version()
+
+  def _check_api_version( self ):
+    # the cached wsdl is good as long as the server's api version has not changed
+    if not _cache_dir_ok():  # nothing on disk, the wsdl was just loaded from the server
+      return
+
+    api_version = self.service.IVirtualBox_getAPIVersion( self.handle )
+    version_file = _cache_path( self.host, 'version' )
+    try:
+      with open( version_file, 'r' ) as fp:
+        cached_version = fp.read().strip()
+    except FileNotFoundError:
+      cached_version = None
+
+    if cached_version == api_version:
+      return
+
+    if cached_version is not None:
+      logging.info( 'virtualbox: api version of "{0}" changed from "{1}" to "{2}", reloading wsdl'.format( self.host, cached_version, api_version ) )
+      self.logout()
+      _flush_service( self.host )
+      self.client, self.service = _get_service( self.host )
+      self.logon()
+
+    with open( version_file, 'w' ) as fp:
+      fp.write( api_version )
+
+  def logon( self ):
     try:
-      self.handle = self.service.IWebsessionManager_logon( username, password )
+      self.handle = self.service.IWebsessionManager_logon( self.username, self.password )
 
     except zeep.exceptions.Fault:
       raise Exception( 'Invalid Credentials' )
 
     self.system_properties_handle = self.service.IVirtualBox_getSystemProperties( self.handle )
+    self._system_properties = None
     self.session = Session( self.service, self.service.IWebsessionManager_getSessionObject( self.handle ) )
 
   def logout( self ):
     self.service.IWebsessionManager_logoff( self.handle )
 
+  def keepalive( self ):  # any call resets vboxwebsrv's session timeout, returns False if the session is allready gone
+    try:
+      self.service.IVirtualBox_getVersion( self.handle )
+    except zeep.exceptions.Fault:
+      return False
+
+    return True
+
   @property
-  def system_properties( self ):
+  def system_properties( self ):  # these don't change for the life of the session
+    if self._system_properties is not None:
+      return self._system_properties
+
     result = {}
     for name, SOAPName in ( ( 'max_boot_position', 'MaxBootPosition' ), ( 'default_machine_folder', 'DefaultMachineFolder' ) ):
       result[ name ] = getattr( self.service, 'ISystemProperties_get' + SOAPName )( self.system_properties_handle )
 
+    self._system_properties = result
     return result
 
   def find_machine( self, vm_name ):
@@ -106,14 +250,10 @@ class VirtualBox:
     return Medium( self.service, self.service.IVirtualBox_createMedium( self.handle, format, location, access_mode, device_type ) )
 
 
-class Session:
+class Session( SOAPObject ):
   state = soap_property( 'ISession', 'State', True )
   console = soap_property( 'ISession', 'Console', True )
 
-  def __init__( self, service, handle ):
-    self.service = service
-    self.handle = handle
-
   @property
   def machine( self ):
     return Machine( self.service, self.service.ISession_getMachine( self.handle ) )
@@ -122,16 +262,16 @@ class Session:
     self.service.ISession_unlockMachine( self.handle )
 
 
-class Progress:
+class Progress( SOAPObject ):
   completed = soap_property( 'IProgress', 'Completed', True )
   canceled = soap_property( 'IProgress', 'Canceled', True )
   percent = soap_property( 'IProgress', 'Percent', True )
   time_remaining = soap_property( 'IProgress', 'TimeRemaining', True )
   result_code = soap_property( 'IProgress', 'ResultCode', True )
 
-  def __init__( self, service, handle ):
-    self.service = service
-    self.handle = handle
+  def wait( self, timeout ):  # timeout in seconds, blocks server side until complete or timeout, returns True if completed
+    self.service.IProgress_waitForCompletion( self.handle, int( timeout * 1000 ) )
+    return self.completed
 
   @property
   def error_info( self ):
@@ -143,17 +283,13 @@ class Progress:
     return result
 
 
-class Machine:
+class Machine( SOAPObject ):
   state = soap_property( 'IMachine', 'State', True )
-  hardware_uuid = soap_property( 'IMachine', 'HardwareUUID' )
-  settings_file_path = soap_property( 'IMachine', 'SettingsFilePath', True )
+  hardware_uuid = soap_property( 'IMachine', 'HardwareUUID', immutable=True )
+  settings_file_path = soap_property( 'IMachine', 'SettingsFilePath', True, True )
   RTC_use_UTC = soap_property( 'IMachine', 'RTCUseUTC' )
   memory_size = soap_property( 'IMachine', 'MemorySize' )
 
-  def __init__( self, service, handle ):
-    self.service = service
-    self.handle = handle
-
   def add_storage_controller( self, name, connection_type ):
     return self.service.IMachine_addStorageController( self.handle, name, connection_type )
 
@@ -188,7 +324,7 @@ class Machine:
     self.service.IConsole_powerButton( session.console )
 
 
-class NetworkAdapter:
+class NetworkAdapter( SOAPObject ):
   enabled = soap_property( 'INetworkAdapter', 'Enabled' )
   mac_address = soap_property( 'INetworkAdapter', 'MACAddress' )
   adapter_type = soap_property( 'INetworkAdapter', 'AdapterType' )
@@ -198,17 +334,12 @@ class NetworkAdapter:
   nat_network = soap_property( 'INetworkAdapter', 'NATNetwork' )
   internal_network = soap_property( 'INetworkAdapter', 'InternalNetwork' )
 
-  def __init__( self, service, handle ):
-    self.service = service
-    self.handle = handle
 
-
-class Medium:
+class Medium( SOAPObject ):
   state = soap_property( 'IMedium', 'State', True )
 
-  def __init__( self, service, handle ):
-    self.service = service
-    self.handle = handle
-
   def create_base_storage( self, logical_size, variant_list ):
     return Progress( self.service, self.service.IMedium_createBaseStorage( self.handle, logical_size, variant_list ) )
+
+  def create_diff_storage( self, target, variant_list ):
+    return Progress( self.service, self.service.IMedium_createDiffStorage( self.handle, target.handle, variant_list ) )
@@ -2,6 +2,8 @@ import logging
 import time
 import os
 import random
+import atexit
+import threading
 
 from subcontractor.credentials import getCredentials
 from subcontractor_plugins.virtualbox import constants
@@ -11,17 +13,86 @@ CREATE_GROUP = ''
 CREATE_GROUPS = []
 CREATE_FLAGS = ''
 
+SESSION_IDLE_TIMEOUT = 240  # in seconds, should be less than vboxwebsrv's session timeout (default 300)
+SESSION_CHECK_INTERVAL = 60  # in seconds, sessions idle longer than this are checked before being reused
+PROGRESS_LOG_INTERVAL = 10  # in seconds, how long to block waiting for a progress before logging where it's at
+
 BOOT_ORDER_MAP = { 'hdd': constants.DeviceType.HardDisk, 'net': constants.DeviceType.Network, 'cd': constants.DeviceType.DVD, 'usb': constants.DeviceType.USB }
 
+_session_pool = {}  # ( host, username, password ) -> [ ( vbox, last_used ), ... ]
+_session_pool_lock = threading.Lock()
+
+
+def _logout( vbox ):
+  logging.debug( 'virtualbox: logging out of "{0}"'.format( vbox.host ) )
+  try:
+    vbox.logout()
+  except Exception as e:
+    logging.warning( 'virtualbox: error logging out of "{0}": "{1}"'.format( vbox.host, e ) )
+
+
+def _logout_all():
+  with _session_pool_lock:
+    vbox_list = [ vbox for idle_list in _session_pool.values() for ( vbox, _ ) in idle_list ]
+    _session_pool.clear()
+
+  for vbox in vbox_list:
+    _logout( vbox )
+
+
+atexit.register( _logout_all )
+
 
 def _connect( connection_paramaters ):
+  # logged in clients are pooled per host/user, each job checks one out, so
+  # no two jobs share a session, and returns it with _disconnect
   creds = connection_paramaters[ 'credentials' ]
   if isinstance( creds, str ):
     creds = getCredentials( creds )
 
+  host = 'http://{0}:18083/'.format( connection_paramaters[ 'host' ] )
+  key = ( host, creds[ 'username' ], creds[ 'password' ] )
+  now = time.time()
+  vbox = None
+  expired_list = []
+  with _session_pool_lock:
+    for pool_key, idle_list in _session_pool.items():
+      expired_list += [ i[0] for i in idle_list if now - i[1] > SESSION_IDLE_TIMEOUT ]
+      idle_list[:] = [ i for i in idle_list if now - i[1] <= SESSION_IDLE_TIMEOUT ]
+
+    try:
+      ( vbox, last_used ) = _session_pool[ key ].pop()
+    except ( KeyError, IndexError ):
+      pass
+
+  for item in expired_list:
+    _logout( item )
+
+  if vbox is not None:
+    if now - last_used > SESSION_CHECK_INTERVAL and not vbox.keepalive():
+      logging.debug( 'virtualbox: session to "{0}" expired, logging in again'.format( host ) )
+      vbox.logon()
+
+    return vbox
+
   logging.debug( 'virtualbox: connecting to "{0}" with user "{1}"'.format( connection_paramaters[ 'host' ], creds[ 'username' ] ) )
 
-  return VirtualBox( 'http://{0}:18083/'.format( connection_paramaters[ 'host' ] ), creds[ 'username' ], creds[ 'password' ] )
+  return VirtualBox( host, creds[ 'username' ], creds[ 'password' ] )
+
+
+def _discard( vbox ):
+  # after a failed job the session may still hold a lock on a machine, or the websession could be
+  # half dead, so it is not put back in the pool
+  logging.debug( 'virtualbox: discarding session to "{0}" after an error'.format( vbox.host ) )
+  _logout( vbox )
+
+
+def _disconnect( vbox ):
+  if vbox is None:  # allready discarded
+    return
+
+  with _session_pool_lock:
+    _session_pool.setdefault( ( vbox.host, vbox.username, vbox.password ), [] ).append( ( vbox, time.time() ) )
 
 
 def create( paramaters ):
@@ -36,113 +107,133 @@ def create( paramaters ):
 
   logging.info( 'virtualbox: creating vm "{0}"'.format( vm_name ) )
   vbox = _connect( connection_paramaters )
-
-  settings_file = vbox.compose_machine_filename( vm_name, CREATE_GROUP, CREATE_FLAGS, vbox.system_properties[ 'default_machine_folder' ] )
-  vm = vbox.create_machine( settings_file, vm_name, CREATE_GROUPS, vm_paramaters[ 'guest_type' ], CREATE_FLAGS )
-  vm.RTC_use_UTC = True
-  vm.memory_size = vm_paramaters[ 'memory_size' ]  # in Meg
-
-  disk_controller_name = 'SCSI'
-  vm.add_storage_controller( disk_controller_name, constants.StorageBus.SCSI )
-  cd_controller_name = 'SATA'
-  vm.add_storage_controller( cd_controller_name, constants.StorageBus.SATA )
-
-  vm.save_settings()
-  logging.debug( 'virtualbox: regestering vm "{0}"'.format( vm_name ) )
-  vbox.register_machine( vm )
-
-  vm.lock( vbox.session, constants.LockType.Write )
   try:
-    vm2 = vbox.session.machine
+    settings_file = vbox.compose_machine_filename( vm_name, CREATE_GROUP, CREATE_FLAGS, vbox.system_properties[ 'default_machine_folder' ] )
+    vm = vbox.create_machine( settings_file, vm_name, CREATE_GROUPS, vm_paramaters[ 'guest_type' ], CREATE_FLAGS )
+    vm.RTC_use_UTC = True
+    vm.memory_size = vm_paramaters[ 'memory_size' ]  # in Meg
 
-    for i in range( 0, vbox.system_properties[ 'max_boot_position' ] ):
-      vm2.set_boot_order( i + 1, constants.DeviceType.Null )
+    disk_controller_name = 'SCSI'
+    vm.add_storage_controller( disk_controller_name, constants.StorageBus.SCSI )
+    cd_controller_name = 'SATA'
+    vm.add_storage_controller( cd_controller_name, constants.StorageBus.SATA )
 
-    for i in range( 0, 4 ):
-      adapter = vm2.get_network_adapter( i )
-      adapter.enabled = False
+    vm.save_settings()
+    logging.debug( 'virtualbox: regestering vm "{0}"'.format( vm_name ) )
+    vbox.register_machine( vm )
 
-    disk_port = 0
-    cd_port = 0
-    for disk in vm_paramaters[ 'disk_list' ]:
-      disk_name = disk[ 'name' ]
-      logging.debug( 'vritualbox: creating disk "{0}" on "{1}"'.format( disk_name, vm_name ) )
-      if 'file' in disk:
-        disk_file = disk[ 'file' ]
+    vm.lock( vbox.session, constants.LockType.Write )
+    try:
+      vm2 = vbox.session.machine
 
-        if disk_file.endswith( '.iso' ):
-          medium = vbox.open_medium( disk_file, constants.DeviceType.DVD, constants.AccessMode.ReadOnly, True )
-          vm2.attach_device( cd_controller_name, cd_port, 0, constants.DeviceType.DVD, medium )
-          cd_port += 1
+      for i in range( 0, vbox.system_properties[ 'max_boot_position' ] ):
+        vm2.set_boot_order( i + 1, constants.DeviceType.Null )
 
-        else:
-          medium = vbox.open_medium( disk_file, constants.DeviceType.HardDisk, constants.AccessMode.ReadWrite, True )
-          vm2.attach_device( disk_controller_name, disk_port, 0, constants.DeviceType.HardDisk, medium )
-          disk_port += 1
+      for i in range( 0, 4 ):
+        adapter = vm2.get_network_adapter( i )
+        adapter.enabled = False
+
+      # start creating all the new disks, then wait for them together
+      new_medium_map = {}
+      for disk in vm_paramaters[ 'disk_list' ]:
+        if 'file' in disk:
+          continue
 
-      else:
+        disk_name = disk[ 'name' ]
+        logging.debug( 'vritualbox: creating disk "{0}" on "{1}"'.format( disk_name, vm_name ) )
         disk_size = disk.get( 'size', 10 ) * 1024 * 1024 * 1024  # disk_size is in bytes, we were pass in G
         disk_format = 'vdi'
         location = '{0}/{1}.vdi'.format( os.path.dirname( vm.settings_file_path ), disk_name )
         medium = vbox.create_medium( disk_format, location, constants.AccessMode.ReadWrite, constants.DeviceType.HardDisk )
-        progress = medium.create_base_storage( disk_size, [ constants.MediumVariant.Standard ] )
-        while not progress.completed:
+        if 'base' in disk:  # a differencing disk on top of the base image, the base stays registered on the host for the next vm to use
+          base_medium = vbox.open_medium( disk[ 'base' ], constants.DeviceType.HardDisk, constants.AccessMode.ReadWrite, False )  # keep the base's uuid, the children of other vms refer to it
+          new_medium_map[ disk_name ] = ( medium, base_medium.create_diff_storage( medium, [ constants.MediumVariant.Standard ] ) )
+        else:
+          new_medium_map[ disk_name ] = ( medium, medium.create_base_storage( disk_size, [ constants.MediumVariant.Standard ] ) )
+
+      for disk_name, ( medium, progress ) in new_medium_map.items():
+        while not progress.wait( PROGRESS_LOG_INTERVAL ):
           logging.debug( 'virtualbox: creating storage for "{0}" disk "{1}" at {2}%, {3} seconds left'.format( vm_name, disk_name, progress.percent, progress.time_remaining ) )
-          time.sleep( 1 )
 
+      for disk_name, ( medium, progress ) in new_medium_map.items():
         if medium.state != constants.MediumState.Created:
           raise Exception( 'disk "{0}" for vm "{1}" faild to create: "{2}"'.format( disk_name, vm_name, progress.error_info[ 'text' ] ) )
 
-        vm2.attach_device( disk_controller_name, disk_port, 0, constants.DeviceType.HardDisk, medium )
-        disk_port += 1
+      disk_port = 0
+      cd_port = 0
+      for disk in vm_paramaters[ 'disk_list' ]:
+        if 'file' in disk:
+          disk_file = disk[ 'file' ]
 
-    for i in range( 0, len( vm_paramaters[ 'interface_list' ] ) ):
-      interface = vm_paramaters[ 'interface_list' ][ i ]
-      adapter = vm2.get_network_adapter( interface[ 'index' ] )
+          if disk_file.endswith( '.iso' ):
+            medium = vbox.open_medium( disk_file, constants.DeviceType.DVD, constants.AccessMode.ReadOnly, True )
+            vm2.attach_device( cd_controller_name, cd_port, 0, constants.DeviceType.DVD, medium )
+            cd_port += 1
 
-      try:
-        adapterType = constants.NetworkAdapterType.__dict__[ interface.get( 'adapter_type', 'I82540EM' ) ]
-      except KeyError:
-        raise ValueError( 'Unknown adapter type "{0}"'.format( interface[ 'adapter_type' ] ) )
+          else:
+            medium = vbox.open_medium( disk_file, constants.DeviceType.HardDisk, constants.AccessMode.ReadWrite, True )
+            vm2.attach_device( disk_controller_name, disk_port, 0, constants.DeviceType.HardDisk, medium )
+            disk_port += 1
 
-      adapter.enabled = True
-      adapter.adapter_type = adapterType
-      adapter.mac_address = interface[ 'mac' ].replace( ':', '' )
+        else:
+          vm2.attach_device( disk_controller_name, disk_port, 0, constants.DeviceType.HardDisk, new_medium_map[ disk[ 'name' ] ][0] )
+          disk_port += 1
 
-      if interface[ 'type' ] == 'host':
-        adapter.attachment_type = constants.NetworkAttachmentType.HostOnly
-        adapter.host_only_interface = interface[ 'network' ]
+      for i in range( 0, len( vm_paramaters[ 'interface_list' ] ) ):
+        interface = vm_paramaters[ 'interface_list' ][ i ]
+        adapter = vm2.get_network_adapter( interface[ 'index' ] )
 
-      elif interface[ 'type' ] == 'bridge':
-        adapter.attachment_type = constants.NetworkAttachmentType.Bridged
-        adapter.bridged_interface = interface[ 'network' ]
+        try:
+          adapterType = constants.NetworkAdapterType.__dict__[ interface.get( 'adapter_type', 'I82540EM' ) ]
+        except KeyError:
+          raise ValueError( 'Unknown adapter type "{0}"'.format( interface[ 'adapter_type' ] ) )
 
-      elif interface[ 'type' ] == 'nat':
-        adapter.attachment_type = constants.NetworkAttachmentType.NATNetwork
-        adapter.nat_network = interface[ 'network' ]
+        adapter.enabled = True
+        adapter.adapter_type = adapterType
+        adapter.mac_address = interface[ 'mac' ].replace( ':', '' )
 
-      elif interface[ 'type' ] == 'internal':
-        adapter.attachment_type = constants.NetworkAttachmentType.Internal
-        adapter.internal_network = interface[ 'network' ]
+        if interface[ 'type' ] == 'host':
+          adapter.attachment_type = constants.NetworkAttachmentType.HostOnly
+          adapter.host_only_interface = interface[ 'network' ]
 
-      else:
-        raise Exception( 'Unknown interface type "{0}"'.format( interface[ 'type' ] ) )
+        elif interface[ 'type' ] == 'bridge':
+          adapter.attachment_type = constants.NetworkAttachmentType.Bridged
+          adapter.bridged_interface = interface[ 'network' ]
 
-    for i in range( 0, vbox.system_properties[ 'max_boot_position' ] ):
-      if i < len( vm_paramaters[ 'boot_order' ] ):
-        try:
-          vm2.set_boot_order( i + 1, BOOT_ORDER_MAP[ vm_paramaters[ 'boot_order' ][ i ] ] )
-        except KeyError:
-          raise Exception( 'Unknown boot item "{0}"'.format( vm_paramaters[ 'boot_order' ][ i ] ) )
+        elif interface[ 'type' ] == 'nat':
+          adapter.attachment_type = constants.NetworkAttachmentType.NATNetwork
+          adapter.nat_network = interface[ 'network' ]
 
-    vm2.save_settings()
+        elif interface[ 'type' ] == 'internal':
+          adapter.attachment_type = constants.NetworkAttachmentType.Internal
+          adapter.internal_network = interface[ 'network' ]
 
-  finally:
-    vbox.session.unlock_machine()
+        else:
+          raise Exception( 'Unknown interface type "{0}"'.format( interface[ 'type' ] ) )
+
+      for i in range( 0, vbox.system_properties[ 'max_boot_position' ] ):
+        if i < len( vm_paramaters[ 'boot_order' ] ):
+          try:
+            vm2.set_boot_order( i + 1, BOOT_ORDER_MAP[ vm_paramaters[ 'boot_order' ][ i ] ] )
+          except KeyError:
+            raise Exception( 'Unknown boot item "{0}"'.format( vm_paramaters[ 'boot_order' ][ i ] ) )
+
+      vm2.save_settings()
+
+    finally:
+      vbox.session.unlock_machine()
+
+    logging.info( 'virtualbox: vm "{0}" created'.format( vm_name ) )
+
+    return { 'done': True, 'uuid': vm.hardware_uuid }
 
-  logging.info( 'virtualbox: vm "{0}" created'.format( vm_name ) )
+  except Exception:
+    _discard( vbox )
+    vbox = None
+    raise
 
-  return { 'done': True, 'uuid': vm.hardware_uuid }
+  finally:
+    _disconnect( vbox )
 
 
 def create_rollback( paramaters ):
@@ -151,41 +242,48 @@ def create_rollback( paramaters ):
   vm_name = vm_paramaters[ 'name' ]
   logging.info( 'virtualbox: rolling back vm "{0}"'.format( vm_name ) )
   vbox = _connect( connection_paramaters )
-
   try:
-    vm = vbox.find_machine( vm_name )
-  except VirtualBoxNotFound:
-    vm = None
+    try:
+      vm = vbox.find_machine( vm_name )
+    except VirtualBoxNotFound:
+      vm = None
 
-  if vm is not None:
-    media = vm.unregister( constants.CleanupMode.DetachAllReturnHardDisksOnly )
-    progress = vm.delete_config( media )
-    while not progress.completed:
-      logging.debug( 'virtualbox: deleting config "{0}" power off at {1}%, {2} seconds left'.format( vm_name, progress.percent, progress.time_remaining ) )
-      time.sleep( 1 )
+    if vm is not None:
+      media = vm.unregister( constants.CleanupMode.DetachAllReturnHardDisksOnly )
+      progress = vm.delete_config( media )
+      while not progress.wait( PROGRESS_LOG_INTERVAL ):
+        logging.debug( 'virtualbox: deleting config "{0}" power off at {1}%, {2} seconds left'.format( vm_name, progress.percent, progress.time_remaining ) )
 
-  # make a list of files that needs to be cleaned up, just incase they are created an not attached, or vm wasn't registerd
-  file_list = [ vbox.compose_machine_filename( vm_name, CREATE_GROUP, CREATE_FLAGS, vbox.system_properties[ 'default_machine_folder' ] ) ]
+    # make a list of files that needs to be cleaned up, just incase they are created an not attached, or vm wasn't registerd
+    file_list = [ vbox.compose_machine_filename( vm_name, CREATE_GROUP, CREATE_FLAGS, vbox.system_properties[ 'default_machine_folder' ] ) ]
 
-  for disk in vm_paramaters[ 'disk_list' ]:
-    disk_name = disk[ 'name' ]
-    if 'file' not in disk:
-      file_list.append( '{0}/{1}.vdi'.format( os.path.dirname( file_list[0] ), disk_name ) )
+    for disk in vm_paramaters[ 'disk_list' ]:
+      disk_name = disk[ 'name' ]
+      if 'file' not in disk:
+        file_list.append( '{0}/{1}.vdi'.format( os.path.dirname( file_list[0] ), disk_name ) )
 
-  logging.debug( 'virtualbox: rollback cleanup file list "{0}"'.format( file_list ) )
-  for file_name in file_list:
-    try:
-      os.unlink( file_name )
-    except OSError as e:
-      if e.errno != 2:  # no such file or directory
-        raise e
+    logging.debug( 'virtualbox: rollback cleanup file list "{0}"'.format( file_list ) )
+    for file_name in file_list:
+      try:
+        os.unlink( file_name )
+      except OSError as e:
+        if e.errno != 2:  # no such file or directory
+          raise e
+
+    # would be nice to clean up temp files and dirs, but really don't know what is safe,
+    # this is rollback anyway, hopfully it get's created right  the next time and everything
+    # get's cleaned up anyway.
+
+    logging.info( 'virtualbox: vm "{0}" rolledback'.format( vm_name ) )
+    return { 'rollback_done': True }
 
-  # would be nice to clean up temp files and dirs, but really don't know what is safe,
-  # this is rollback anyway, hopfully it get's created right  the next time and everything
-  # get's cleaned up anyway.
+  except Exception:
+    _discard( vbox )
+    vbox = None
+    raise
 
-  logging.info( 'virtualbox: vm "{0}" rolledback'.format( vm_name ) )
-  return { 'rollback_done': True }
+  finally:
+    _disconnect( vbox )
 
 
 def destroy( paramaters ):
@@ -194,20 +292,27 @@ def destroy( paramaters ):
   vm_name = paramaters[ 'name' ]
   logging.info( 'virtualbox: destroying vm "{0}"({1})'.format( vm_name, vm_uuid ) )
   vbox = _connect( connection_paramaters )
-
   try:
-    vm = vbox.find_machine( vm_uuid )
-  except VirtualBoxNotFound:
-    return { 'done': True }  # it's gone, we are donne
+    try:
+      vm = vbox.find_machine( vm_uuid )
+    except VirtualBoxNotFound:
+      return { 'done': True }  # it's gone, we are donne
+
+    media = vm.unregister( constants.CleanupMode.DetachAllReturnHardDisksOnly )
+    progress = vm.delete_config( media )
+    while not progress.wait( PROGRESS_LOG_INTERVAL ):
+      logging.debug( 'virtualbox: deleting config "{0}"({1}) at {2}%, {3} seconds left'.format( vm_name, vm_uuid, progress.percent, progress.time_remaining ) )
+
+    logging.info( 'virtualbox: vm "{0}" destroyed'.format( vm_name ) )
+    return { 'done': True }
 
-  media = vm.unregister( constants.CleanupMode.DetachAllReturnHardDisksOnly )
-  progress = vm.delete_config( media )
-  while not progress.completed:
-    logging.debug( 'virtualbox: deleting config "{0}"({1}) at {2}%, {3} seconds left'.format( vm_name, vm_uuid, progress.percent, progress.time_remaining ) )
-    time.sleep( 1 )
+  except Exception:
+    _discard( vbox )
+    vbox = None
+    raise
 
-  logging.info( 'virtualbox: vm "{0}" destroyed'.format( vm_name ) )
-  return { 'done': True }
+  finally:
+    _disconnect( vbox )
 
 
 def get_interface_map( paramaters ):
@@ -217,17 +322,25 @@ def get_interface_map( paramaters ):
   interface_list = []
   logging.info( 'virtualbox: getting interface map "{0}"({1})'.format( vm_name, vm_uuid ) )
   vbox = _connect( connection_paramaters )
+  try:
+    vm = vbox.find_machine( vm_name )
+
+    for i in range( 0, 4 ):
+      adapter = vm.get_network_adapter( i )
+      if not adapter.enabled:  # stop after the first disabled one
+        break
 
-  vm = vbox.find_machine( vm_name )
+      interface_list.append( adapter.mac_address )
 
-  for i in range( 0, 4 ):
-    adapter = vm.get_network_adapter( i )
-    if not adapter.enabled:  # stop after the first disabled one
-      break
+    return { 'interface_list': interface_list }
 
-    interface_list.append( adapter.mac_address )
+  except Exception:
+    _discard( vbox )
+    vbox = None
+    raise
 
-  return { 'interface_list': interface_list }
+  finally:
+    _disconnect( vbox )
 
 
 def _power_state_convert( state ):
@@ -248,41 +361,51 @@ def set_power( paramaters ):
   desired_state = paramaters[ 'state' ]
   logging.info( 'virtualbox: setting power state of "{0}"({1}) to "{2}"...'.format( vm_name, vm_uuid, desired_state ) )
   vbox = _connect( connection_paramaters )
+  try:
+    vm = vbox.find_machine( vm_name )
 
-  vm = vbox.find_machine( vm_name )
+    curent_state = _power_state_convert( vm.state )
+    if curent_state == desired_state or ( curent_state == 'off' and desired_state == 'soft_off' ):
+      return { 'state': curent_state }
 
-  curent_state = _power_state_convert( vm.state )
-  if curent_state == desired_state or ( curent_state == 'off' and desired_state == 'soft_off' ):
-    return { 'state': curent_state }
+    progress = None
+    if desired_state == 'on':
+      progress = vm.launch_vm_process( vbox.session )
 
-  progress = None
-  if desired_state == 'on':
-    progress = vm.launch_vm_process( vbox.session )
+    elif desired_state == 'off':
+      vm.lock( vbox.session, constants.LockType.Shared )
+      try:
+        vbox.session.machine.power_down( vbox.session )
+      finally:
+        vbox.session.unlock_machine()
 
-  elif desired_state == 'off':
-    vm.lock( vbox.session, constants.LockType.Shared )
-    try:
-      vbox.session.machine.power_down( vbox.session )
-    finally:
-      vbox.session.unlock_machine()
+    elif desired_state == 'soft_off':
+      vm.lock( vbox.session, constants.LockType.Shared )
+      try:
+        vbox.session.machine.power_button( vbox.session )
+      finally:
+        vbox.session.unlock_machine()
 
-  elif desired_state == 'soft_off':
-    vm.lock( vbox.session, constants.LockType.Shared )
-    try:
-      vbox.session.machine.power_button( vbox.session )
-    finally:
-      vbox.session.unlock_machine()
+    else:
+      raise Exception( 'Unknown desired state "{0}"'.format( desired_state ) )
 
-  else:
-    raise Exception( 'Unknown desired state "{0}"'.format( desired_state ) )
+    if progress is not None:
+      try:
+        while not progress.wait( PROGRESS_LOG_INTERVAL ):
+          logging.debug( 'virtualbox: vm "{0}"({1}) power "{2}" at {3}%, {4} seconds left'.format( vm_name, vm_uuid, desired_state, progress.percent, progress.time_remaining ) )
+      finally:
+        vbox.session.unlock_machine()  # launch_vm_process leaves the session locked to the vm, it must be free before the session is reused
 
-  if progress is not None:
-    while not progress.completed:
-      logging.debug( 'virtualbox: vm "{0}"({1}) power "{2}" at {3}%, {4} seconds left'.format( vm_name, vm_uuid, desired_state, progress.percent, progress.time_remaining ) )
-      time.sleep( 1 )
+    logging.info( 'virtualbox: setting power state of "{0}"({1}) to "{2}" complete'.format( vm_name, vm_uuid, desired_state ) )
+    return { 'state': _power_state_convert( vm.state ) }
 
-  logging.info( 'virtualbox: setting power state of "{0}"({1}) to "{2}" complete'.format( vm_name, vm_uuid, desired_state ) )
-  return { 'state': _power_state_convert( vm.state ) }
+  except Exception:
+    _discard( vbox )
+    vbox = None
+    raise
+
+  finally:
+    _disconnect( vbox )
 
 
 def power_state( paramaters ):
@@ -291,7 +414,15 @@ def power_state( paramaters ):
   vm_name = paramaters[ 'name' ]
   logging.info( 'virtualbox: getting "{0}"({1}) power state...'.format( vm_name, vm_uuid ) )
   vbox = _connect( connection_paramaters )
+  try:
+    vm = vbox.find_machine( vm_uuid )
 
-  vm = vbox.find_machine( vm_uuid )
+    return { 'state': _power_state_convert( vm.state ) }
 
-  return { 'state': _power_state_convert( vm.state ) }
+  except Exception:
+    _discard( vbox )
+    vbox = None
+    raise
+
+  finally:
+    _disconnect( vbox )